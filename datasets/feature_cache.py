@@ -0,0 +1,84 @@
+"""
+Backbone feature cache for runs with a frozen (prefix of the) backbone.
+
+The frozen backbone layers give the same output every epoch, so they are run once per scan and their output feature
+maps are stored as float16 in a scan store (memory-mapped, see datasets/scan_store.py). Training then reads the
+features and only runs the trainable layers, transformer and head (BackboneBase.input_layer).
+
+A cache is specific to the samples (the dataset preprocessing hash) and to the frozen weights (weights hash of the
+cached layers), it is saved in <scan set dir>/feature_cache/<layer>_<preprocess hash>_<weights hash>. It is rebuilt
+when the scans or their sources (PICAI2021Dataset.source_fingerprints) changed.
+Random augmentations would be frozen in the cache, it is only meant for deterministic transforms.
+"""
+import os
+
+import numpy as np
+import torch
+
+from datasets.scan_store import ScanStore, ScanStoreWriter, is_scan_store
+from utils.util import is_dist_avail_and_initialized, is_main_process
+
+
+class FeatureCacheDataset(object):
+    """Cached backbone features [num_slices x C x h x w] (float16) and slice labels of a scan set"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.store = ScanStore(cache_dir)
+
+    def __len__(self):
+        return len(self.store)
+
+    def slice_lengths(self):
+        return [scan['arrays']['features']['shape'][0] for scan in self.store.scans]
+
+    def __getitem__(self, idx):
+        features = np.array(self.store.get(idx, 'features'))
+        labels = np.array(self.store.get(idx, 'labels'))
+        return tuple([features, labels])
+
+
+def feature_cache_dir(backbone, dataset, layer):
+    prefix = list(backbone.body.keys())
+    prefix = prefix[:prefix.index(layer) + 1]
+    return os.path.join(dataset.files_dir, 'feature_cache',
+                        f'{layer}_{dataset.preprocess_hash()}_{backbone.weights_hash(prefix)}')
+
+
+def build_feature_cache(backbone, dataset, layer, device, dtype=np.float16):
+    """Runs the backbone layers up to `layer` over all the scans of the dataset and stores their output.
+    An existing cache of the same samples and weights is reused.
+
+    Parameters:
+        backbone: BackboneBase of the model, the layers up to `layer` must be frozen
+        dataset: PICAI2021Dataset
+        layer: last cached body layer, e.g. 'layer1' (trainable layer2-4) or 'layer4' (frozen backbone)
+    Returns:
+        FeatureCacheDataset of the cache
+    """
+    if layer not in backbone.frozen_prefix():
+        raise ValueError(f'Backbone layer {layer} is not frozen, its features cannot be cached')
+    cache_dir = feature_cache_dir(backbone, dataset, layer)
+    scan_ids = [os.path.basename(scan_path).split('.')[0] for scan_path in dataset.scan_list]
+    sources = dataset.source_fingerprints()
+    build = not is_scan_store(cache_dir)
+    if not build and [(scan['scan_id'], scan.get('source')) for scan in ScanStore(cache_dir).scans] != \
+            list(zip(scan_ids, sources)):
+        print(f'Rebuilding outdated feature cache {cache_dir}')
+        build = True
+
+    if is_main_process() and build:
+        print(f'Building feature cache of {layer} for {len(dataset)} scans in {cache_dir}')
+        was_training = backbone.training
+        backbone.eval()
+        with torch.no_grad(), ScanStoreWriter(cache_dir, {'features': dtype, 'labels': np.int64}) as writer:
+            for idx, scan_id in enumerate(scan_ids):
+                scan, labels = dataset[idx]
+                scan = torch.as_tensor(scan).float().to(device)
+                features = backbone.forward_until(scan, layer)
+                writer.append(scan_id, {'features': features.cpu().numpy(), 'labels': np.asarray(labels)},
+                              source=sources[idx])
+        backbone.train(was_training)
+    if is_dist_avail_and_initialized():
+        torch.distributed.barrier()
+    return FeatureCacheDataset(cache_dir)
@@ -1,4 +1,5 @@
 import json
+import hashlib
 from collections import OrderedDict
 from pathlib import Path
 import os
@@ -12,6 +13,7 @@ import numpy as np
 import skimage
 import scipy
 import torch
+import torch.nn.functional as F
 import SimpleITK as sitk
 
 from batchgenerators.dataloading.data_loader import DataLoader
@@ -19,13 +21,23 @@ from monai.transforms import Compose, EnsureType
 from picai_baseline.unet.training_setup.image_reader import SimpleITKDataset
 from torch.utils.data import Dataset, DataLoader
 
+from datasets.scan_store import ScanStore, ScanStoreWriter, file_fingerprint, is_scan_store
+from utils.util import is_main_process
+
 
 class PICAI2021Dataset:
     def __init__(self, data_dir, transforms=None, fold_id=0, scan_set='', input_size=128,
-                 resize_mode='interpolate', mask=True, crop_prostate=True, padding=0, task='cls'):
+                 resize_mode='interpolate', mask=True, crop_prostate=True, padding=0, task='cls', use_cache=True,
+                 dtype=np.float32, resize_backend='cv2'):
         # ignore_list = ['10084_1000084', '11441_1001465', '10152_1000154']  # '11441_1001465'
         files_dir = os.path.join(data_dir, f'fold_{fold_id}',scan_set) if (scan_set == 'train' or scan_set == 'val') else data_dir
-        self.scan_list = [os.path.join(files_dir,f) for f in os.listdir(files_dir) if f.endswith('.pkl')]
+        store_dir = os.path.join(files_dir, 'scan_store')
+        if is_scan_store(store_dir):
+            self.scan_store = ScanStore(store_dir)
+            self.scan_list = [os.path.join(files_dir, scan['scan_id'] + '.pkl') for scan in self.scan_store.scans]
+        else:
+            self.scan_store = None
+            self.scan_list = [os.path.join(files_dir,f) for f in os.listdir(files_dir) if f.endswith('.pkl')]
         # self.scan_list = [os.path.join(files_dir, f) for f in os.listdir(files_dir) if f.endswith('.pkl') and f.split('.')[0] not in ignore_list]
         self.input_size = input_size
         self.mask = mask
@@ -34,79 +46,238 @@ class PICAI2021Dataset:
         self.padding = padding
         self._transforms = transforms
         self.task = task
+        self.files_dir = files_dir
+        # dtype of the returned samples, float32 or float16 (the model input is converted on the device)
+        self.dtype = np.dtype(dtype)
+        # 'cv2': resize_scan per slice and modality, 'torch': resize_volume of all the slices and modalities at once
+        if resize_backend not in ('cv2', 'torch'):
+            raise ValueError(f'Unknown resize backend {resize_backend}')
+        self.resize_backend = resize_backend
+
+        # preprocessed samples written by build_preprocess_cache for the current preprocessing parameters
+        self.cache = None
+        cache_dir = self.preprocess_cache_dir()
+        if use_cache and is_scan_store(cache_dir):
+            cache = ScanStore(cache_dir)
+            cache_idx = {os.path.join(files_dir, scan['scan_id'] + '.pkl'): idx for idx, scan in enumerate(cache.scans)}
+            # a cache of other scans or of changed sources is not used, the samples are preprocessed on the fly
+            # (rebuild it with preprocess/build_preprocess_cache.py)
+            if set(cache_idx) == set(self.scan_list) and \
+                    [cache.scans[cache_idx[scan_path]].get('source') for scan_path in self.scan_list] == \
+                    self.source_fingerprints():
+                self.cache = cache
+                self._cache_idx = [cache_idx[scan_path] for scan_path in self.scan_list]
+            else:
+                print(f'Ignoring outdated preprocess cache {cache_dir}')
 
     def __len__(self):
         return len(self.scan_list)
 
+    def slice_lengths(self):
+        """Number of slices of every sample, read from the cache / scan store index. For pickle datasets the lengths
+        are computed once and saved to slice_lengths.json in the scan set directory (by the main process), with the
+        source fingerprint of every scan: the lengths of reprocessed scans are recomputed."""
+        crop_slices = self.mask and self.crop_prostate
+        if self.cache is not None:
+            return [self.cache.meta(idx)['arrays']['img_concat']['shape'][0] for idx in self._cache_idx]
+        if self.scan_store is not None:
+            return [len(scan['prostate_slices']) if crop_slices else scan['arrays']['t2w']['shape'][0]
+                    for scan in self.scan_store.scans]
+
+        lengths_path = os.path.join(self.files_dir, 'slice_lengths.json')
+        lengths = {}
+        if os.path.isfile(lengths_path):
+            with open(lengths_path) as fp:
+                lengths = json.load(fp)
+        scan_ids = [os.path.basename(scan_path).split('.')[0] for scan_path in self.scan_list]
+        sources = self.source_fingerprints()
+        if any(lengths.get(scan_id, {}).get('source') != source for scan_id, source in zip(scan_ids, sources)):
+            for scan_id, scan_path, source in zip(scan_ids, self.scan_list, sources):
+                if lengths.get(scan_id, {}).get('source') == source:
+                    continue
+                with open(scan_path, 'rb') as handle:
+                    scan_dict = pickle.load(handle)
+                prostate_slices = scan_dict.get('prostate_slices')
+                if prostate_slices is None:
+                    prostate_slices = get_prostate_slices(scan_dict['prostate_mask'])
+                lengths[scan_id] = {'all': int(scan_dict['prostate_mask'].shape[0]), 'prostate': len(prostate_slices),
+                                    'source': source}
+            if is_main_process():
+                # written to a temporary file and renamed, so concurrent readers never see a partial file
+                tmp_path = f'{lengths_path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'w') as fp:
+                    json.dump(lengths, fp)
+                os.replace(tmp_path, lengths_path)
+        return [lengths[scan_id]['prostate' if crop_slices else 'all'] for scan_id in scan_ids]
+
+    def source_fingerprints(self):
+        """Fingerprint of the source of every scan of scan_list: the modification time and size of its pickle, as
+        recorded in the scan store when it is read from one. Stored in the caches built from the dataset to detect
+        reprocessed sources."""
+        if self.scan_store is not None:
+            return [scan.get('source') for scan in self.scan_store.scans]
+        return [file_fingerprint(scan_path) for scan_path in self.scan_list]
+
+    def preprocess_params(self):
+        # the cache is stored in the dtype of the samples
+        params = {'input_size': self.input_size, 'resize_mode': self.resize_mode, 'mask': self.mask,
+                  'crop_prostate': self.crop_prostate, 'padding': self.padding, 'task': self.task,
+                  'dtype': self.dtype.name}
+        if self.resize_backend != 'cv2':
+            # the default backend is left out, so caches built before the option existed keep their hash
+            params['resize_backend'] = self.resize_backend
+        return params
+
+    def preprocess_hash(self):
+        return hashlib.md5(json.dumps(self.preprocess_params(), sort_keys=True).encode()).hexdigest()[:12]
+
+    def preprocess_cache_dir(self):
+        return os.path.join(self.files_dir, 'preprocess_cache', self.preprocess_hash())
+
+    def build_preprocess_cache(self):
+        """Materializes the masked, cropped and resized samples (before transforms) of the current preprocessing
+        parameters in the sample dtype, so later runs only copy them from a memmap. Picked up automatically by new
+        instances with the same parameters, as long as their sources did not change."""
+        cache_dir = self.preprocess_cache_dir()
+        transforms, self._transforms = self._transforms, None
+        self.cache = None
+        sources = self.source_fingerprints()
+        with ScanStoreWriter(cache_dir, {'img_concat': self.dtype, 'labels': np.int64}) as writer:
+            for idx, scan_path in enumerate(self.scan_list):
+                img_concat, labels = self[idx]
+                writer.append(os.path.basename(scan_path).split('.')[0], {'img_concat': img_concat, 'labels': labels},
+                              source=sources[idx])
+        with open(os.path.join(cache_dir, 'params.json'), 'w') as fp:
+            json.dump(self.preprocess_params(), fp)
+        self._transforms = transforms
+        self.cache = ScanStore(cache_dir)
+        self._cache_idx = list(range(len(self.scan_list)))
+        return cache_dir
+
     def __getitem__(self, idx):
-        with open(self.scan_list[idx], 'rb') as handle:
-            scan_dict = pickle.load(handle)
+        if self.cache is not None:
+            img_concat = np.array(self.cache.get(self._cache_idx[idx], 'img_concat'), dtype=self.dtype)
+            labels = np.array(self.cache.get(self._cache_idx[idx], 'labels'))
+            if self._transforms is not None:
+                img_concat = self._transforms(img_concat)
+            return tuple([img_concat, labels])
 
-        img_t2w = scan_dict['modalities']['t2w']
-        img_adc = scan_dict['modalities']['adc']
-        img_dwi = scan_dict['modalities']['dwi']
-        prostate_slices = np.ones(scan_dict['prostate_mask'].shape[0], dtype=bool)
+        if self.scan_store is not None:
+            imgs, mask, labels = self._load_from_store(idx)
+        else:
+            imgs, mask, labels = self._load_from_pickle(idx)
 
-        if self.mask:
-            img_t2w *= scan_dict['prostate_mask']
-            img_adc *= scan_dict['prostate_mask']
-            img_dwi *= scan_dict['prostate_mask']
-            if self.crop_prostate:
-                y1, y2, x1, x2 = get_square_crop_coords(scan_dict['prostate_mask'], padding=self.padding) # CHECK HERE
-                prostate_slices = np.sum(scan_dict['prostate_mask'], axis=(1,2)) > 0
-                img_t2w = img_t2w[prostate_slices, y1:y2, x1:x2]
-                img_adc = img_adc[prostate_slices, y1:y2, x1:x2]
-                img_dwi = img_dwi[prostate_slices, y1:y2, x1:x2]
-
-        if self.input_size != img_t2w.shape[1]:
-            if self.resize_mode == 'interpolate' or (self.resize_mode == 'padding' and self.input_size < img_t2w.shape[1]):
-                img_t2w = resize_scan(img_t2w, size=self.input_size)
-                img_adc = resize_scan(img_adc, size=self.input_size)
-                img_dwi = resize_scan(img_dwi, size=self.input_size)
-            elif self.resize_mode == 'padding':
-                padding = self.input_size - img_t2w.shape[1]
-                side_pad = padding//2
-                if padding % 2 == 0:
-                    img_t2w = np.pad(img_t2w, ((0,0),(side_pad,side_pad),(side_pad,side_pad)))
-                    img_adc = np.pad(img_adc, ((0,0),(side_pad,side_pad),(side_pad,side_pad)))
-                    img_dwi = np.pad(img_dwi, ((0,0),(side_pad,side_pad),(side_pad,side_pad)))
-                else:
-                    img_t2w = np.pad(img_t2w, ((0,0),(side_pad,side_pad+1),(side_pad,side_pad+1)))
-                    img_adc = np.pad(img_adc, ((0,0),(side_pad,side_pad+1),(side_pad,side_pad+1)))
-                    img_dwi = np.pad(img_dwi, ((0,0),(side_pad,side_pad+1),(side_pad,side_pad+1)))
+        # the masked, resized / padded modalities are written to a single [num_slices x 3 x input_size x input_size]
+        # buffer (the collate_fn wraps it without a copy only for a batch of one unpadded scan). The cv2 backend
+        # resizes into the buffer channels slice by slice, the torch backend resizes the stacked modalities at once
+        num_slices, height, width = imgs[0].shape
+        resize = self.input_size != height and (self.resize_mode == 'interpolate' or
+                                                (self.resize_mode == 'padding' and self.input_size < height))
+        if resize and self.resize_backend == 'torch':
+            volume = np.empty((num_slices, 3, height, width), dtype=np.float32)
+            stack_modalities(imgs, mask, volume)
+            img_concat = resize_volume(volume, size=self.input_size).astype(self.dtype, copy=False)
+        else:
+            padding = self.input_size - height if not resize and self.resize_mode == 'padding' else 0
+            out_shape = (self.input_size, self.input_size) if resize else (height + padding, width + padding)
+            pad = padding // 2
+            # only the padded border has to be zero initialized
+            alloc = np.zeros if padding else np.empty
+            img_concat = alloc((num_slices, 3) + out_shape, dtype=self.dtype)
+            if resize:
+                for channel, img in enumerate(imgs):
+                    resize_scan(img, size=self.input_size, mask=mask, out=img_concat[:, channel])
+            else:
+                # a single pad of the stacked modalities
+                stack_modalities(imgs, mask, img_concat[:, :, pad:pad + height, pad:pad + width])
 
         # f, ax = plt.subplots(1, 3)
         # slice = 10
-        # ax[0].imshow(img_t2w[slice,:,:], cmap='gray')
-        # ax[1].imshow(img_adc[slice,:,:], cmap='gray')
-        # ax[2].imshow(img_dwi[slice,:,:], cmap='gray')
+        # ax[0].imshow(img_concat[slice,0,:,:], cmap='gray')
+        # ax[1].imshow(img_concat[slice,1,:,:], cmap='gray')
+        # ax[2].imshow(img_concat[slice,2,:,:], cmap='gray')
         # plt.show()
 
-        # img_concat = np.concatenate([img_t2w, img_adc, img_dwi], axis=1).squeeze(0).transpose(1, 0, 2, 3)
-        img_concat = np.stack([img_t2w, img_adc, img_dwi], axis=1)
-
         # apply the transforms
         if self._transforms is not None:
             img_concat = self._transforms(img_concat)
 
         # if self.seg_transform is not None:
         #     seg = apply_transform(self.seg_transform, seg, map_items=False)
-        labels = scan_dict['cls_labels'] if self.task=='cls' else scan_dict['seg_labels']
-        labels =labels[prostate_slices]
 
         return tuple([img_concat, labels])
         # return tuple([img_concat, seg_labels if self.get_seg_labels else cls_labels])
 
-def get_square_crop_coords(mask, padding=0):
-    y1 = x1 = np.inf
-    y2 = x2 = 0
-    for slice_num in range(mask.shape[0]):
-        y_nonzero, x_nonzero = np.nonzero(mask[slice_num, :, :])
-        if len(y_nonzero) > 0:
-            y1 = min(np.min(y_nonzero), y1)
-            y2 = max(np.max(y_nonzero), y2)
-            x1 = min(np.min(x_nonzero), x1)
-            x2 = max(np.max(x_nonzero), x2)
+    def _load_from_pickle(self, idx):
+        """Returns the cropped t2w, adc and dwi scans, the cropped prostate mask (None if not masking) and the slice
+        labels. The mask is applied by __getitem__ when the modalities are written to the sample buffer."""
+        with open(self.scan_list[idx], 'rb') as handle:
+            scan_dict = pickle.load(handle)
+
+        imgs = [scan_dict['modalities'][mod] for mod in ('t2w', 'adc', 'dwi')]
+        prostate_mask = scan_dict['prostate_mask']
+        prostate_slices = np.ones(prostate_mask.shape[0], dtype=bool)
+        cur_mask = None
+
+        if self.mask:
+            cur_mask = prostate_mask
+            if self.crop_prostate:
+                # crop boxes and slice indices are stored by preprocess_picai, legacy pickles fall back to the mask
+                y1, y2, x1, x2 = get_square_crop_coords(prostate_mask, padding=self.padding,
+                                                        crop_box=scan_dict.get('crop_box'))
+                prostate_slices = scan_dict.get('prostate_slices')
+                if prostate_slices is None:
+                    prostate_slices = get_prostate_slices(prostate_mask)
+                imgs = [img[prostate_slices, y1:y2, x1:x2] for img in imgs]
+                cur_mask = prostate_mask[prostate_slices, y1:y2, x1:x2]
+
+        labels = scan_dict['cls_labels'] if self.task=='cls' else scan_dict['seg_labels']
+        labels =labels[prostate_slices]
+        return imgs, cur_mask, labels
+
+    def _load_from_store(self, idx):
+        """Same as _load_from_pickle. The memmaps are read only and are not copied here, only the slices and rows
+        that survive the crop are read from disk when the sample buffer is written."""
+        prostate_mask = self.scan_store.get(idx, 'prostate_mask')
+        meta = self.scan_store.meta(idx)
+        prostate_slices = slice(None)
+        crop = (slice(None), slice(None))
+        if self.mask and self.crop_prostate:
+            y1, y2, x1, x2 = get_square_crop_coords(prostate_mask, padding=self.padding, crop_box=meta['crop_box'])
+            prostate_slices = np.asarray(meta['prostate_slices'])
+            if len(prostate_slices) and np.all(np.diff(prostate_slices) == 1):
+                # contiguous slices are indexed as a view of the memmap, which is only read into the sample buffer
+                prostate_slices = slice(int(prostate_slices[0]), int(prostate_slices[-1]) + 1)
+            crop = (slice(y1, y2), slice(x1, x2))
+
+        imgs = [self.scan_store.get(idx, mod)[(prostate_slices,) + crop] for mod in ('t2w', 'adc', 'dwi')]
+        cur_mask = prostate_mask[(prostate_slices,) + crop] if self.mask else None
+
+        if self.task == 'cls':
+            labels = np.asarray(meta['cls_labels'])
+        else:
+            labels = np.array(self.scan_store.get(idx, 'seg_labels'))
+        labels = labels[prostate_slices]
+        return imgs, cur_mask, labels
+
+def get_square_crop_coords(mask, padding=0, crop_box=None):
+    """Square crop around the prostate mask, padded by `padding` pixels on every side, or the full frame if the mask
+    is empty. A box precomputed with get_prostate_crop_box can be passed as crop_box to skip the mask scan."""
+    if crop_box is None:
+        crop_box = get_prostate_crop_box(mask)
+    if crop_box is None:
+        return 0, mask.shape[1], 0, mask.shape[2]
+    y1, y2, x1, x2 = crop_box
+    return y1 - padding, y2 + padding, x1 - padding, x2 + padding
+
+def get_prostate_crop_box(mask):
+    """Unpadded square crop box (y1, y2, x1, x2) of all the slices of the prostate mask, None if the mask is empty"""
+    y_nonzero = np.flatnonzero(np.any(mask, axis=(0, 2)))
+    x_nonzero = np.flatnonzero(np.any(mask, axis=(0, 1)))
+    if not len(y_nonzero):
+        return None
+    y1, y2 = int(y_nonzero[0]), int(y_nonzero[-1])
+    x1, x2 = int(x_nonzero[0]), int(x_nonzero[-1])
 
     crop_x_diff = x2 - x1
     crop_y_diff = y2 - y1
@@ -120,20 +291,51 @@ def get_square_crop_coords(mask, padding=0):
         x1_temp, x2_temp = x1, x2
         x1 -= int(min(x1_temp, pad // 2) + max(x2_temp + np.ceil(pad / 2) - mask.shape[1], 0))
         x2 += int(min(np.ceil(pad / 2), mask.shape[1] - x2_temp) + max(0 - (x1_temp - pad // 2), 0))
-
-    y1 -= padding
-    y2 += padding
-    x1 -= padding
-    x2 += padding
     return y1, y2, x1, x2
 
-def resize_scan(scan, size=128):
+def get_prostate_slices(mask):
+    """Indices of the slices that contain prostate, all the slices if the mask is empty"""
+    prostate_slices = np.flatnonzero(np.any(mask, axis=(1, 2)))
+    if not len(prostate_slices):
+        return np.arange(mask.shape[0])
+    return prostate_slices
+
+def stack_modalities(imgs, mask, out):
+    """Writes the [num_slices x H x W] modalities, multiplied by the mask if given, to the channels of the
+    [num_slices x len(imgs) x H x W] out (may be a view of a larger buffer)"""
+    for channel, img in enumerate(imgs):
+        if mask is None:
+            np.copyto(out[:, channel], img, casting='unsafe')
+        else:
+            np.multiply(img, mask, out=out[:, channel], casting='unsafe')
+    return out
+
+def resize_volume(volume, size=128):
+    """Resizes all the slices and channels of a [num_slices x C x H x W] float32 volume to size x size with a single
+    bicubic interpolation. It uses the same cubic kernel and border clamping as cv2.INTER_CUBIC (resize_scan), the
+    outputs match within float32 rounding."""
+    volume = torch.from_numpy(volume)
+    return F.interpolate(volume, size=(size, size), mode='bicubic', align_corners=False).numpy()
+
+def resize_scan(scan, size=128, mask=None, out=None):
+    """Resizes the slices of a [num_slices x H x W] scan to size x size (bicubic), multiplied by the mask if given.
+    The slices are written to out ([num_slices x size x size], may be a channel view of a larger buffer), which is
+    allocated as float32 if not given. Returns out."""
     # zoom_factor = (1, size/scan.shape[1], size/scan.shape[2])
     # scan_rs = scipy.ndimage.zoom(scan,zoom_factor)
-    scan_rs = np.zeros((len(scan), size, size))
+    if out is None:
+        out = np.empty((len(scan), size, size), dtype=np.float32)
+    # cv2 writes to dst in place only if it is a contiguous float32 slice, otherwise the slice is copied
+    direct = out.dtype == np.float32 and out[0].flags.c_contiguous
+    cur_slice = np.empty(scan.shape[1:], dtype=np.float32)
     for idx in range(len(scan)):
-        cur_slice = scan[idx, :, :]
+        if mask is None:
+            np.copyto(cur_slice, scan[idx], casting='unsafe')
+        else:
+            np.multiply(scan[idx], mask[idx], out=cur_slice, casting='unsafe')
         # cur_slice_rs = skimage.transform.resize(cur_slice, (size, size),anti_aliasing=True)
-        cur_slice_rs = cv2.resize(cur_slice, (size, size), interpolation=cv2.INTER_CUBIC)
-        scan_rs[idx, :, :] = cur_slice_rs
-    return scan_rs
+        if direct:
+            cv2.resize(cur_slice, (size, size), dst=out[idx], interpolation=cv2.INTER_CUBIC)
+        else:
+            out[idx] = cv2.resize(cur_slice, (size, size), interpolation=cv2.INTER_CUBIC)
+    return out
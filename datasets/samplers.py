@@ -0,0 +1,87 @@
+"""
+Batch samplers for scans with variable numbers of slices.
+"""
+import math
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+import utils.util as utils
+
+
+class SliceBucketBatchSampler(Sampler):
+    """Groups scans with similar numbers of slices into the same batches to reduce padding.
+
+    Scans are assigned to buckets by bucket_boundaries (e.g. [16, 24, 32] makes the buckets <16, 16-23, 24-31 and
+    >=32) and batches are formed inside each bucket. Like DistributedSampler, the shuffling is seeded by
+    seed + epoch (call set_epoch before every epoch) and every rank gets an equal share of the batches.
+
+    Parameters:
+        lengths: number of slices of every scan of the dataset (see PICAI2021Dataset.slice_lengths)
+        batch_size: number of scans per batch
+        bucket_boundaries: sorted slice counts separating the buckets
+        slice_bucket: scans are padded to a multiple of slice_bucket slices (see utils.collate_fn)
+        shuffle: shuffle the scans and the order of the batches
+        drop_last: drop the last incomplete batch of every bucket
+        num_replicas, rank: distributed processes, default from the initialized process group
+        seed: random seed, must be identical across processes
+    """
+
+    def __init__(self, lengths, batch_size, bucket_boundaries, slice_bucket=1, shuffle=True, drop_last=True,
+                 num_replicas=None, rank=None, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_ids = np.digitize(self.lengths, bucket_boundaries)
+        self.slice_bucket = slice_bucket
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = utils.get_world_size() if num_replicas is None else num_replicas
+        self.rank = utils.get_rank() if rank is None else rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_slices = 0
+        self.num_padded_slices = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.lengths), generator=g).numpy() if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for bucket_id in np.unique(self.bucket_ids):
+            bucket = indices[self.bucket_ids[indices] == bucket_id]
+            for start in range(0, len(bucket), self.batch_size):
+                batch = bucket[start:start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch.tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=g).tolist()]
+        # every rank gets the same number of batches
+        num_batches = len(batches) // self.num_replicas * self.num_replicas
+        return batches[self.rank:num_batches:self.num_replicas]
+
+    def __iter__(self):
+        batches = self._batches()
+        self.num_slices = 0
+        self.num_padded_slices = 0
+        for batch in batches:
+            batch_lengths = self.lengths[batch]
+            self.num_slices += int(batch_lengths.sum())
+            self.num_padded_slices += len(batch) * math.ceil(batch_lengths.max() / self.slice_bucket) * self.slice_bucket
+        return iter(batches)
+
+    def __len__(self):
+        bucket_sizes = np.bincount(self.bucket_ids)
+        if self.drop_last:
+            num_batches = int(np.sum(bucket_sizes // self.batch_size))
+        else:
+            num_batches = int(np.sum(np.ceil(bucket_sizes / self.batch_size)))
+        return num_batches // self.num_replicas
+
+    @property
+    def padding_overhead(self):
+        """Fraction of padded slices out of the real slices in the batches of the current epoch"""
+        return self.num_padded_slices / max(self.num_slices, 1) - 1
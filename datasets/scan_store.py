@@ -0,0 +1,178 @@
+"""
+Columnar on-disk scan store.
+
+Every array key (e.g. 't2w', 'adc', 'dwi', 'prostate_mask') is written to its own contiguous raw file, and a
+json index keeps, for every scan, the element offset and shape of each of its arrays. Reading a scan back is an
+np.memmap view, so only the bytes of the requested slices are read from disk and nothing is unpickled.
+
+Layout of a store directory:
+    index.json          {'dtypes': {key: dtype}, 'scans': [{'scan_id': ..., 'arrays': {key: {'offset', 'shape'}},
+                                                            'cls_labels', 'crop_box', 'prostate_slices',
+                                                            'source'}]}
+    <key>.dat           raw C-ordered data of all scans for that key, concatenated
+"""
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+INDEX_FILE = 'index.json'
+
+
+def file_fingerprint(path):
+    """Modification time and size of a file, identifies the version of a source scan"""
+    stat = os.stat(path)
+    return f'{stat.st_mtime_ns}-{stat.st_size}'
+
+
+def is_scan_store(store_dir):
+    return os.path.isfile(os.path.join(store_dir, INDEX_FILE))
+
+
+class ScanStoreWriter(object):
+    """Appends scans to a store directory. Call close() (or use as a context manager) to write the index.
+
+    The store is written to a temporary directory next to store_dir, which replaces store_dir on close(). Readers of
+    an existing store keep their memmaps of the old (complete) files, the new store is only visible once complete.
+    """
+
+    def __init__(self, store_dir, dtypes):
+        """
+        Parameters:
+            store_dir: output directory of the store
+            dtypes: dict mapping every array key to the dtype it is stored in
+        """
+        self.store_dir = os.path.normpath(store_dir)
+        self.dtypes = {key: np.dtype(dtype).str for key, dtype in dtypes.items()}
+        self.scans = []
+        self._offsets = {key: 0 for key in dtypes}
+        self._tmp_dir = f'{self.store_dir}.tmp{os.getpid()}'
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+        os.makedirs(self._tmp_dir)
+        self._files = {key: open(os.path.join(self._tmp_dir, key + '.dat'), 'wb') for key in dtypes}
+
+    def append(self, scan_id, arrays, **meta):
+        """
+        Parameters:
+            scan_id: name of the scan
+            arrays: dict with an array for every key of the store
+            meta: additional json serializable per scan fields (labels, crop boxes, etc.)
+        """
+        entry = {'scan_id': scan_id, 'arrays': {}}
+        for key, handle in self._files.items():
+            arr = np.ascontiguousarray(arrays[key], dtype=self.dtypes[key])
+            arr.tofile(handle)
+            entry['arrays'][key] = {'offset': self._offsets[key], 'shape': list(arr.shape)}
+            self._offsets[key] += arr.size
+        entry.update(meta)
+        self.scans.append(entry)
+
+    def close(self):
+        for handle in self._files.values():
+            handle.close()
+        with open(os.path.join(self._tmp_dir, INDEX_FILE), 'w') as fp:
+            json.dump({'dtypes': self.dtypes, 'scans': self.scans}, fp)
+        # the complete store replaces the old one, whose files stay readable through already open memmaps
+        if os.path.isdir(self.store_dir):
+            old_dir = f'{self.store_dir}.old{os.getpid()}'
+            os.rename(self.store_dir, old_dir)
+            os.rename(self._tmp_dir, self.store_dir)
+            shutil.rmtree(old_dir)
+        else:
+            os.rename(self._tmp_dir, self.store_dir)
+
+    def abort(self):
+        """Discards the partially written store, an existing store is left untouched"""
+        for handle in self._files.values():
+            handle.close()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ScanStore(object):
+    """Read only access to a store written by ScanStoreWriter.
+
+    The memmaps are opened lazily, so the store can be handed to DataLoader workers without copying the data
+    (each worker opens its own maps on first access).
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self._index_fingerprint = file_fingerprint(os.path.join(store_dir, INDEX_FILE))
+        with open(os.path.join(store_dir, INDEX_FILE)) as fp:
+            index = json.load(fp)
+        self.dtypes = {key: np.dtype(dtype) for key, dtype in index['dtypes'].items()}
+        self.scans = index['scans']
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.scans)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def _map(self, key):
+        if key not in self._maps:
+            # the data files of a rebuilt store do not match the loaded index
+            if file_fingerprint(os.path.join(self.store_dir, INDEX_FILE)) != self._index_fingerprint:
+                raise RuntimeError(f'The scan store {self.store_dir} was rebuilt while it was in use')
+            self._maps[key] = np.memmap(os.path.join(self.store_dir, key + '.dat'), dtype=self.dtypes[key], mode='r')
+        return self._maps[key]
+
+    def get(self, idx, key):
+        """Returns a read only memmap view of array `key` of scan `idx`"""
+        info = self.scans[idx]['arrays'][key]
+        size = int(np.prod(info['shape']))
+        return self._map(key)[info['offset']:info['offset'] + size].reshape(info['shape'])
+
+    def meta(self, idx):
+        return self.scans[idx]
+
+
+def build_scan_store(pkl_dir, store_dir=None):
+    """Converts a directory of per scan pickles (as written by preprocess_picai) into a scan store.
+
+    Parameters:
+        pkl_dir: directory with the .pkl files of a single scan set
+        store_dir: output directory, default is pkl_dir/scan_store
+    """
+    # imported here since picai2022 itself reads scan stores
+    from datasets.picai2022 import get_prostate_crop_box, get_prostate_slices
+
+    if store_dir is None:
+        store_dir = os.path.join(pkl_dir, 'scan_store')
+    pkl_files = sorted(f for f in os.listdir(pkl_dir) if f.endswith('.pkl'))
+    dtypes = {'t2w': np.float32, 'adc': np.float32, 'dwi': np.float32, 'prostate_mask': np.uint8,
+              'seg_labels': np.uint8}
+    with ScanStoreWriter(store_dir, dtypes) as writer:
+        for pkl_file in pkl_files:
+            pkl_path = os.path.join(pkl_dir, pkl_file)
+            with open(pkl_path, 'rb') as handle:
+                scan_dict = pickle.load(handle)
+            arrays = dict(scan_dict['modalities'])
+            arrays['prostate_mask'] = scan_dict['prostate_mask'] > 0
+            arrays['seg_labels'] = scan_dict['seg_labels']
+            crop_box = scan_dict.get('crop_box')
+            if crop_box is None:
+                crop_box = get_prostate_crop_box(scan_dict['prostate_mask'])
+            prostate_slices = scan_dict.get('prostate_slices')
+            if prostate_slices is None:
+                prostate_slices = get_prostate_slices(scan_dict['prostate_mask'])
+            writer.append(pkl_file.split('.')[0], arrays,
+                          cls_labels=np.asarray(scan_dict['cls_labels']).astype(int).tolist(),
+                          crop_box=None if crop_box is None else [int(c) for c in crop_box],
+                          prostate_slices=np.asarray(prostate_slices).astype(int).tolist(),
+                          source=file_fingerprint(pkl_path))
+    return store_dir
@@ -0,0 +1,132 @@
+"""
+Exports a trained VisTRcls checkpoint to a deployment graph and checks the output parity with the eager model.
+
+Formats:
+    'torchscript':  torch.jit.trace module (.ts). Tracing fixes the number of slices to trace_slices (the positional
+                    embedding is resized at trace time), so scans must be resampled / padded to it.
+                    Load with torch.jit.load(path)
+    'export':       torch.export program (.pt2, torch >= 2.2) with a dynamic number of slices in
+                    [min_slices, max_slices]. Load with torch.export.load(path).module()
+    'onnx':         ONNX graph (.onnx) with a dynamic slice axis, for CPU inference with ONNX Runtime.
+                    Load with models.onnx_runtime.OnnxRuntimeModel(path), or set TEST.BACKEND: onnx in test.py
+
+The exported model takes a single scan [num_slices x 3 x H x W] and returns the slice logits [num_slices x 1].
+"""
+import os
+import torch
+import yaml
+
+import utils.util as utils
+from models.vistr import build_model
+
+SETTINGS = {
+    'config_name': 'proles_picai_input128_resnet101_pos_emb_sine_t_depth_6_emb_size_2048_mask_crop_prostate',
+    'checkpoint_path': '/mnt/DATA2/Sagi/Models/ProLesClassifier/proles_picai_input128_resnet101_pos_emb_sine_t_depth_6_emb_size_2048_mask_crop_prostate/ckpt/checkpoint0035.pth',
+    'output_path': None,  # if None, saved next to the checkpoint
+    'format': 'torchscript',  # options: 'torchscript', 'export' (torch >= 2.2) or 'onnx'
+    'device': 'cpu',
+    'min_slices': 2,
+    'max_slices': 64,
+    'trace_slices': 40,  # torchscript: fixed number of slices, onnx: slices of the example input
+    'onnx_opset': 17,
+    'parity_slices': [8, 21, 40],  # slice counts checked against the eager model
+    'atol': 1e-4,
+}
+
+
+def check_export_format(export_format):
+    # torch.export.Dim (dynamic_shapes) was added in torch 2.2
+    if export_format == 'export' and not hasattr(getattr(torch, 'export', None), 'Dim'):
+        raise RuntimeError(f"The 'export' format requires torch >= 2.2 (found {torch.__version__}), "
+                           f"use 'torchscript' or 'onnx'")
+
+
+def export_model(model, input_size, settings):
+    model.eval()
+    device = next(model.parameters()).device
+    if settings['format'] == 'export':
+        example = torch.randn(max(settings['min_slices'], 2), 3, input_size, input_size, device=device)
+        num_slices = torch.export.Dim('num_slices', min=settings['min_slices'], max=settings['max_slices'])
+        return torch.export.export(model, (example,), dynamic_shapes=({0: num_slices},))
+    elif settings['format'] == 'torchscript':
+        example = torch.randn(settings['trace_slices'], 3, input_size, input_size, device=device)
+        with torch.no_grad():
+            return torch.jit.trace(model, example)
+    raise ValueError(f'Unknown export format {settings["format"]}')
+
+
+def export_onnx(model, input_size, path, settings):
+    model.eval()
+    device = next(model.parameters()).device
+    example = torch.randn(settings['trace_slices'], 3, input_size, input_size, device=device)
+    torch.onnx.export(model, (example,), path, input_names=['scan'], output_names=['logits'],
+                      opset_version=settings['onnx_opset'],
+                      dynamic_axes={'scan': {0: 'num_slices'}, 'logits': {0: 'num_slices'}})
+
+
+def save_exported(exported, path, export_format):
+    if export_format == 'export':
+        torch.export.save(exported, path)
+    else:
+        torch.jit.save(exported, path)
+
+
+def load_exported(path):
+    if path.endswith('.pt2'):
+        return torch.export.load(path).module()
+    if path.endswith('.onnx'):
+        from models.onnx_runtime import OnnxRuntimeModel
+        return OnnxRuntimeModel(path)
+    return torch.jit.load(path)
+
+
+def check_parity(model, exported, input_size, slice_counts, atol):
+    """Compares the exported model to the eager model, raises if the logits differ by more than atol"""
+    model.eval()
+    device = next(model.parameters()).device
+    for num_slices in slice_counts:
+        scan = torch.randn(num_slices, 3, input_size, input_size, device=device)
+        with torch.no_grad():
+            expected = model(scan)
+            actual = exported(scan)
+        max_diff = (expected - actual).abs().max().item()
+        print(f'{num_slices} slices: max |logit diff| {max_diff:.2e}')
+        if not max_diff <= atol:
+            raise AssertionError(f'Exported model differs from the eager model for {num_slices} slices '
+                                 f'({max_diff:.2e} > {atol})')
+
+
+def main(config, settings):
+    check_export_format(settings['format'])
+    device = torch.device(settings['device'])
+    config.DEVICE = device
+    model = build_model(config)
+    checkpoint = torch.load(settings['checkpoint_path'], map_location='cpu')
+    model.load_state_dict(checkpoint['model'])
+    model.to(device).eval()
+
+    output_path = settings['output_path']
+    if output_path is None:
+        suffix = {'export': '.pt2', 'torchscript': '.ts', 'onnx': '.onnx'}[settings['format']]
+        output_path = os.path.splitext(settings['checkpoint_path'])[0] + suffix
+    if settings['format'] == 'onnx':
+        export_onnx(model, config.DATA.INPUT_SIZE, output_path, settings)
+    else:
+        exported = export_model(model, config.DATA.INPUT_SIZE, settings)
+        save_exported(exported, output_path, settings['format'])
+    print(f'Saved {settings["format"]} model to {output_path}')
+
+    if settings['format'] == 'torchscript':
+        slice_counts = [settings['trace_slices']]
+    else:
+        slice_counts = settings['parity_slices']
+    check_parity(model, load_exported(output_path), config.DATA.INPUT_SIZE, slice_counts, settings['atol'])
+    print('Done!')
+
+
+if __name__ == '__main__':
+    settings = SETTINGS
+    with open('configs/' + settings['config_name'] + '.yaml', "r") as yamlfile:
+        config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+    config = utils.RecursiveNamespace(**config)
+    main(config, settings)
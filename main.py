@@ -7,6 +7,7 @@ from torch import nn
 import yaml
 import wandb
 import random
+from functools import partial
 from pathlib import Path
 import utils.transforms as T
 # from datasets.picai2022 import prepare_datagens
@@ -16,6 +17,8 @@ import utils.util as utils
 from utils.engine import train_one_epoch, eval_epoch
 from datasets.proles2021_debug import ProLes2021DatasetDebug
 from datasets.picai2022 import PICAI2021Dataset
+from datasets.samplers import SliceBucketBatchSampler
+from datasets.feature_cache import build_feature_cache
 
 from torch.utils.data import DataLoader, RandomSampler, DistributedSampler, BatchSampler
 
@@ -47,6 +50,11 @@ def main(config, settings):
     if config.distributed:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[config.gpu])
         model_without_ddp = model.module
+    if config.MODEL.COMPILE:
+        if not hasattr(torch, 'compile'):
+            raise RuntimeError(f'MODEL.COMPILE requires torch >= 2.0 (found {torch.__version__})')
+        # checkpoints are still saved from model_without_ddp, so their keys do not change
+        model = torch.compile(model)
 
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print('number of params:', n_parameters)
@@ -64,6 +72,19 @@ def main(config, settings):
     # criterion = nn.BCELoss()
     criterion = nn.BCEWithLogitsLoss()
 
+    # the checkpoint is loaded before the data, the backbone feature cache is built from the resumed weights
+    if config.TRAINING.RESUME:
+        if config.TRAINING.RESUME.startswith('https'):
+            checkpoint = torch.hub.load_state_dict_from_url(
+                config.TRAINING.RESUME, map_location='cpu', check_hash=True)
+        else:
+            checkpoint = torch.load(config.TRAINING.RESUME, map_location='cpu')
+        model_without_ddp.load_state_dict(checkpoint['model'])
+        if not config.TRAINING.EVAL and 'optimizer' in checkpoint and 'lr_scheduler' in checkpoint and 'epoch' in checkpoint:
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+            config.TRAINING.START_EPOCH = checkpoint['epoch'] + 1
+
     # transforms
     transforms = T.Compose([
         T.ToTensor()
@@ -82,15 +103,26 @@ def main(config, settings):
         dataset_train = PICAI2021Dataset(config.DATA.DATASET_PATH, fold_id=config.DATA.DATA_FOLD, scan_set='train',
                                          input_size=config.DATA.INPUT_SIZE,
                                          resize_mode=config.DATA.PREPROCESS.RESIZE_MODE,
+                                         resize_backend=config.DATA.PREPROCESS.RESIZE_BACKEND,
                                          mask=config.DATA.PREPROCESS.MASK_PROSTATE,
                                          crop_prostate=config.DATA.PREPROCESS.CROP_PROSTATE,
-                                         padding=config.DATA.PREPROCESS.CROP_PADDING)
+                                         padding=config.DATA.PREPROCESS.CROP_PADDING,
+                                         dtype=config.DATA.PREPROCESS.DTYPE)
         dataset_val = PICAI2021Dataset(config.DATA.DATASET_PATH, fold_id=config.DATA.DATA_FOLD, scan_set='val',
                                        input_size=config.DATA.INPUT_SIZE,
                                        resize_mode=config.DATA.PREPROCESS.RESIZE_MODE,
+                                       resize_backend=config.DATA.PREPROCESS.RESIZE_BACKEND,
                                        mask=config.DATA.PREPROCESS.MASK_PROSTATE,
                                        crop_prostate=config.DATA.PREPROCESS.CROP_PROSTATE,
-                                       padding=config.DATA.PREPROCESS.CROP_PADDING)
+                                       padding=config.DATA.PREPROCESS.CROP_PADDING,
+                                       dtype=config.DATA.PREPROCESS.DTYPE)
+    if config.TRAINING.FEATURE_CACHE:
+        # the frozen backbone prefix is run once, training reads its cached output features
+        backbone = model_without_ddp.backbone[0]
+        cache_layer = backbone.frozen_prefix()[-1]
+        dataset_train = build_feature_cache(backbone, dataset_train, cache_layer, device)
+        dataset_val = build_feature_cache(backbone, dataset_val, cache_layer, device)
+        backbone.input_layer = cache_layer
     if config.distributed:
         sampler_train = DistributedSampler(dataset_train)
         sampler_val = DistributedSampler(dataset_val)
@@ -98,42 +130,59 @@ def main(config, settings):
         sampler_train = RandomSampler(dataset_train)
         sampler_val = RandomSampler(dataset_val)
 
-    batch_sampler_train = BatchSampler(sampler_train, config.TRAINING.BATCH_SIZE, drop_last=True)
-    data_loader_train = DataLoader(dataset_train, batch_sampler=batch_sampler_train, num_workers=config.TRAINING.NUM_WORKERS)
+    # workers are kept between epochs and batches are pinned, so they are copied to the device asynchronously
+    # (engine.DataPrefetcher)
+    loader_kwargs = {'num_workers': config.TRAINING.NUM_WORKERS, 'pin_memory': device.type == 'cuda'}
+    if config.TRAINING.NUM_WORKERS > 0:
+        loader_kwargs.update(persistent_workers=config.TRAINING.PERSISTENT_WORKERS,
+                             prefetch_factor=config.TRAINING.PREFETCH_FACTOR)
+    # scans of a batch are padded to a common number of slices
+    collate_fn = partial(utils.collate_fn, slice_bucket=config.TRAINING.SLICE_BUCKET)
+    if config.TRAINING.BUCKET_SAMPLER:
+        # batches of scans with similar numbers of slices, shuffled and sharded per rank by the sampler itself
+        batch_sampler_train = SliceBucketBatchSampler(dataset_train.slice_lengths(), config.TRAINING.BATCH_SIZE,
+                                                      config.TRAINING.BUCKET_BOUNDARIES,
+                                                      slice_bucket=config.TRAINING.SLICE_BUCKET, shuffle=True,
+                                                      seed=settings['seed'])
+    else:
+        batch_sampler_train = BatchSampler(sampler_train, config.TRAINING.BATCH_SIZE, drop_last=True)
+    data_loader_train = DataLoader(dataset_train, batch_sampler=batch_sampler_train, collate_fn=collate_fn,
+                                   **loader_kwargs)
     # data_loader_train = DataLoader(dataset_train, num_workers=config.TRAINING.NUM_WORKERS)
 
-    batch_sampler_val = BatchSampler(sampler_val, config.TRAINING.BATCH_SIZE, drop_last=True)
-    data_loader_val = DataLoader(dataset_val, batch_sampler=batch_sampler_val, num_workers=config.TRAINING.NUM_WORKERS)
+    if config.TRAINING.BUCKET_SAMPLER:
+        batch_sampler_val = SliceBucketBatchSampler(dataset_val.slice_lengths(), config.TRAINING.BATCH_SIZE,
+                                                    config.TRAINING.BUCKET_BOUNDARIES,
+                                                    slice_bucket=config.TRAINING.SLICE_BUCKET, shuffle=False)
+    else:
+        batch_sampler_val = BatchSampler(sampler_val, config.TRAINING.BATCH_SIZE, drop_last=True)
+    data_loader_val = DataLoader(dataset_val, batch_sampler=batch_sampler_val, collate_fn=collate_fn,
+                                 **loader_kwargs)
     # data_loader_val = DataLoader(dataset_val, num_workers=config.TRAINING.NUM_WORKERS)
 
     output_dir = os.path.join(Path(config.DATA.OUTPUT_DIR), settings['exp_name'])
     ckpt_dir = os.path.join(output_dir, 'ckpt')
     os.makedirs(ckpt_dir, exist_ok=True)
 
-    if config.TRAINING.RESUME:
-        if config.TRAINING.RESUME.startswith('https'):
-            checkpoint = torch.hub.load_state_dict_from_url(
-                config.TRAINING.RESUME, map_location='cpu', check_hash=True)
-        else:
-            checkpoint = torch.load(config.TRAINING.RESUME, map_location='cpu')
-        model_without_ddp.load_state_dict(checkpoint['model'])
-        if not config.TRAINING.EVAL and 'optimizer' in checkpoint and 'lr_scheduler' in checkpoint and 'epoch' in checkpoint:
-            optimizer.load_state_dict(checkpoint['optimizer'])
-            lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
-            config.TRAINING.START_EPOCH = checkpoint['epoch'] + 1
-
     print("Start training")
     start_time = time.time()
     for epoch in range(config.TRAINING.START_EPOCH, config.TRAINING.EPOCHS):
         # if config.distributed:
         #     sampler_train.set_epoch(epoch)
+        if config.TRAINING.BUCKET_SAMPLER:
+            batch_sampler_train.set_epoch(epoch)
         train_stats = train_one_epoch(
             model, criterion, data_loader_train, optimizer, device, epoch,
-            config.TRAINING.CLIP_MAX_NORM, config.TRAINING.CLS_THRESH)
+            config.TRAINING.CLIP_MAX_NORM, config.TRAINING.CLS_THRESH, config.TRAINING.SYNC_FREE_LOGGING,
+            config.TRAINING.PRECISION)
+        if config.TRAINING.BUCKET_SAMPLER:
+            train_stats['padding_overhead'] = batch_sampler_train.padding_overhead
+            print(f'Padding overhead: {100 * train_stats["padding_overhead"]:.1f}% padded slices')
         if epoch % config.TRAINING.EVAL_INTERVAL == 0:
             val_stats = eval_epoch(
                 model, criterion, data_loader_val, device, epoch,
-                config.TRAINING.CLIP_MAX_NORM, config.TRAINING.CLS_THRESH)
+                config.TRAINING.CLIP_MAX_NORM, config.TRAINING.CLS_THRESH, config.TRAINING.SYNC_FREE_LOGGING,
+                config.TRAINING.PRECISION)
         if settings['use_wandb']:
             if epoch % config.TRAINING.EVAL_INTERVAL == 0:
                 wandb.log(
@@ -144,6 +193,7 @@ def main(config, settings):
                      "Train/Precision": train_stats['precision'],
                      "Train/F1": train_stats['f1'],
                      'Train/lr': train_stats['lr'],
+                     'Train/PaddingOverhead': train_stats.get('padding_overhead', 0),
                      "Validation/Loss": val_stats['loss'],
                      "Validation/Accuracy": val_stats['acc'],
                      "Validation/Sensitivity": val_stats['sensitivity'],
@@ -160,6 +210,7 @@ def main(config, settings):
                      "Train/Precision": train_stats['precision'],
                      "Train/F1": train_stats['f1'],
                      'Train/lr': train_stats['lr'],
+                     'Train/PaddingOverhead': train_stats.get('padding_overhead', 0),
                      "epoch": epoch})
         lr_scheduler.step()
         if config.DATA.OUTPUT_DIR:
@@ -0,0 +1,113 @@
+"""
+Memory / compute trade-off of activation checkpointing (MODEL.BACKBONE.CHECKPOINT_LAYERS and
+MODEL.TRANSFORMER.CHECKPOINT_LAYERS).
+
+For every checkpointing setting it reports the train step time, the activation memory retained after the forward
+pass (what grows with the number of slices) and the peak memory of the forward + backward pass. On CPU the memory is
+taken from the profiler allocation events, on CUDA from the caching allocator. The gradients are compared to the
+ones of the run without checkpointing.
+"""
+import copy
+import os
+import sys
+import time
+import torch
+import yaml
+from torch import nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils.util as utils
+from models.vistr import build_model
+
+# SETTINGS:
+settings = {
+    'config_name': 'proles_picai_input128_resnet101_pos_emb_sine_t_depth_6_emb_size_2048_mask_crop_prostate',
+    'device': 'cpu',
+    'num_slices': 40,
+    'steps': 3,
+    # (backbone layer groups, number of transformer blocks)
+    'variants': [([], 0),
+                 ([], 'all'),
+                 (['layer2', 'layer3', 'layer4'], 0),
+                 (['layer2', 'layer3', 'layer4'], 'all')],
+}
+
+
+def set_checkpointing(model, backbone_layers, transformer_blocks):
+    model.backbone[0].checkpoint_layers = set(backbone_layers)
+    if transformer_blocks == 'all':
+        transformer_blocks = len(model.transformer.layers)
+    model.transformer.checkpoint_layers = transformer_blocks
+
+
+def forward_backward(model, criterion, samples, targets):
+    model.zero_grad(set_to_none=True)
+    loss = criterion(model(samples), targets)
+    loss.backward()
+
+
+def profile_memory(model, criterion, samples, targets, device):
+    """Returns the memory retained after the forward pass and the peak memory of forward + backward, in bytes"""
+    model.zero_grad(set_to_none=True)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        start = torch.cuda.memory_allocated()
+        torch.cuda.reset_peak_memory_stats()
+        loss = criterion(model(samples), targets)
+        retained = torch.cuda.memory_allocated() - start
+        loss.backward()
+        return retained, torch.cuda.max_memory_allocated() - start
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        loss = criterion(model(samples), targets)
+    retained = sum(event.self_cpu_memory_usage for event in prof.key_averages())
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        loss.backward()
+    current = peak = retained
+    for event in sorted(prof.events(), key=lambda event: event.time_range.start):
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return retained, peak
+
+
+def main(config, settings):
+    device = torch.device(settings['device'])
+    config.DEVICE = device
+    torch.manual_seed(0)
+    base_model = build_model(config).to(device).train()
+    # no dropout / drop path, so the gradients of the different settings can be compared
+    for module in base_model.modules():
+        if isinstance(module, nn.Dropout) or module.__class__.__name__ == 'DropPath':
+            module.p = module.drop_prob = 0.
+    criterion = nn.BCEWithLogitsLoss()
+    size = config.DATA.INPUT_SIZE
+    samples = torch.randn(settings['num_slices'], 3, size, size, device=device)
+    targets = torch.randint(0, 2, (settings['num_slices'], 1), device=device).float()
+
+    print(f'{settings["num_slices"]} slices of {size}x{size}')
+    print(f'{"backbone layers":>30} {"transformer blocks":>18} {"step [ms]":>10} {"retained [MB]":>14} '
+          f'{"peak [MB]":>10} {"max |dgrad|":>12}')
+    reference = None
+    for backbone_layers, transformer_blocks in settings['variants']:
+        model = copy.deepcopy(base_model)
+        set_checkpointing(model, backbone_layers, transformer_blocks)
+        forward_backward(model, criterion, samples, targets)
+        grads = [p.grad for p in model.parameters() if p.grad is not None]
+        if reference is None:
+            reference = grads
+        max_diff = max((g - r).abs().max().item() for g, r in zip(grads, reference))
+        retained, peak = profile_memory(model, criterion, samples, targets, device)
+        start = time.perf_counter()
+        for _ in range(settings['steps']):
+            forward_backward(model, criterion, samples, targets)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        step_time = (time.perf_counter() - start) / settings['steps']
+        print(f'{str(backbone_layers):>30} {str(transformer_blocks):>18} {1e3 * step_time:10.1f} '
+              f'{retained / 2 ** 20:14.1f} {peak / 2 ** 20:10.1f} {max_diff:12.2e}')
+
+
+if __name__ == '__main__':
+    with open('configs/' + settings['config_name'] + '.yaml', "r") as yamlfile:
+        config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+    config = utils.RecursiveNamespace(**config)
+    main(config, settings)
@@ -0,0 +1,106 @@
+"""
+PICAI2021Dataset.__getitem__ latency and memory: the time to produce the model input tensor of a scan (the sample
+plus its conversion to float32, done in numpy here so that tracemalloc sees it) and the peak of the numpy allocations
+during it, compared to the size of the returned sample. A peak of ~1x the sample means no intermediate copies.
+
+By default synthetic scans are written to a temporary directory, both as pickles and as a scan store, so both loading
+paths are measured. Set data_dir to a scan set directory (with .pkl files and / or a scan_store) to use real scans.
+"""
+import itertools
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datasets.picai2022 import PICAI2021Dataset, get_prostate_crop_box, get_prostate_slices
+from datasets.scan_store import build_scan_store
+
+# SETTINGS:
+settings = {
+    'data_dir': None,  # None for synthetic scans
+    'num_scans': 8,
+    'scan_shape': (24, 384, 384),  # synthetic scans [num_slices x H x W]
+    'input_size': 128,
+    'resize_modes': ['interpolate', 'padding'],
+    'resize_backends': ['cv2', 'torch'],
+    'dtypes': [np.float32, np.float16],
+    'repeats': 3,
+}
+
+
+def write_synthetic_scans(data_dir, num_scans, scan_shape, seed=0):
+    rng = np.random.default_rng(seed)
+    num_slices, height, width = scan_shape
+    for idx in range(num_scans):
+        prostate_mask = np.zeros(scan_shape, dtype=np.uint8)
+        prostate_mask[num_slices // 4:3 * num_slices // 4, height // 3:2 * height // 3, width // 3:width // 2] = 1
+        modalities = {mod: rng.standard_normal(scan_shape, dtype=np.float32) for mod in ('t2w', 'adc', 'dwi')}
+        scan_dict = {'modalities': modalities, 'prostate_mask': prostate_mask,
+                     'cls_labels': rng.integers(0, 2, num_slices), 'seg_labels': np.zeros(scan_shape, dtype=np.uint8),
+                     'crop_box': get_prostate_crop_box(prostate_mask),
+                     'prostate_slices': get_prostate_slices(prostate_mask)}
+        with open(os.path.join(data_dir, f'{idx:05d}_{idx:07d}.pkl'), 'wb') as handle:
+            pickle.dump(scan_dict, handle)
+
+
+def model_input(dataset, idx):
+    img_concat, _ = dataset[idx]
+    if img_concat.dtype not in (np.float32, np.float16):
+        # converted with .float() by the engine, float16 samples are converted on the device
+        img_concat = img_concat.astype(np.float32)
+    return torch.from_numpy(img_concat)
+
+
+def benchmark(dataset, repeats):
+    """Mean latency [s], mean peak allocations and sample size [bytes]"""
+    for idx in range(len(dataset)):
+        model_input(dataset, idx)  # warm up the page cache
+    latency = peak = size = 0
+    for _ in range(repeats):
+        for idx in range(len(dataset)):
+            start = time.perf_counter()
+            model_input(dataset, idx)
+            latency += time.perf_counter() - start
+    for idx in range(len(dataset)):
+        tracemalloc.start()
+        sample = model_input(dataset, idx)
+        peak += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        size += sample.numel() * sample.element_size()
+    num_samples = len(dataset)
+    return latency / (repeats * num_samples), peak / num_samples, size / num_samples
+
+
+def main(settings):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = settings['data_dir']
+        if data_dir is None:
+            data_dir = tmp_dir
+            write_synthetic_scans(data_dir, settings['num_scans'], settings['scan_shape'])
+            build_scan_store(data_dir)
+        print(f'{"source":>10} {"resize":>12} {"backend":>8} {"dtype":>8} {"latency [ms]":>13} {"peak [MB]":>10} '
+              f'{"sample [MB]":>12}')
+        for source, resize_mode, resize_backend, dtype in itertools.product(
+                ['pickle', 'store'], settings['resize_modes'], settings['resize_backends'], settings['dtypes']):
+            dataset = PICAI2021Dataset(data_dir, input_size=settings['input_size'], resize_mode=resize_mode,
+                                       use_cache=False, dtype=dtype, resize_backend=resize_backend)
+            if source == 'pickle':
+                if not any(f.endswith('.pkl') for f in os.listdir(data_dir)):
+                    continue
+                dataset.scan_store = None
+                dataset.scan_list = sorted(os.path.join(data_dir, f) for f in os.listdir(data_dir)
+                                           if f.endswith('.pkl'))
+            elif dataset.scan_store is None:
+                continue
+            latency, peak, size = benchmark(dataset, settings['repeats'])
+            print(f'{source:>10} {resize_mode:>12} {resize_backend:>8} {np.dtype(dtype).name:>8} '
+                  f'{latency * 1e3:13.2f} {peak / 2 ** 20:10.2f} {size / 2 ** 20:12.2f}')
+
+
+if __name__ == '__main__':
+    main(settings)
@@ -0,0 +1,78 @@
+"""
+Per scan latency and throughput of ONNX Runtime (CPU execution provider) vs. eager PyTorch on the same scans.
+The model is exported with export.export_onnx to a temporary file, the logits of both backends are compared.
+"""
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+import yaml
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils.util as utils
+from export import SETTINGS as EXPORT_SETTINGS, export_onnx
+from models.onnx_runtime import OnnxRuntimeModel
+from models.vistr import build_model
+
+# SETTINGS:
+settings = {
+    'config_name': 'proles_picai_input128_resnet101_pos_emb_sine_t_depth_6_emb_size_2048_mask_crop_prostate',
+    'checkpoint_path': None,  # None for random weights
+    'num_threads': 0,  # threads of both backends, 0 for the defaults
+    'slice_counts': [12, 20, 28, 40],  # slices of the benchmark scans
+    'scans_per_count': 3,
+    'warmup_scans': 2,
+}
+
+
+def run_scans(model, scans, warmup_scans):
+    with torch.no_grad():
+        for scan in scans[:warmup_scans]:
+            model(scan)
+        logits, latencies = [], []
+        for scan in scans:
+            start = time.perf_counter()
+            logits.append(model(scan))
+            latencies.append(time.perf_counter() - start)
+    return logits, np.array(latencies)
+
+
+def main(config, settings):
+    config.DEVICE = torch.device('cpu')
+    if settings['num_threads'] > 0:
+        torch.set_num_threads(settings['num_threads'])
+    torch.manual_seed(0)
+    model = build_model(config)
+    if settings['checkpoint_path'] is not None:
+        model.load_state_dict(torch.load(settings['checkpoint_path'], map_location='cpu')['model'])
+    model.eval()
+    size = config.DATA.INPUT_SIZE
+    scans = [torch.randn(num_slices, 3, size, size)
+             for num_slices in settings['slice_counts'] for _ in range(settings['scans_per_count'])]
+    num_slices = sum(scan.shape[0] for scan in scans)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        onnx_path = os.path.join(tmp_dir, 'model.onnx')
+        export_onnx(model, size, onnx_path, EXPORT_SETTINGS)
+        ort_model = OnnxRuntimeModel(onnx_path, num_threads=settings['num_threads'])
+
+        print(f'{len(scans)} scans, {num_slices} slices of {size}x{size}, torch threads: {torch.get_num_threads()}')
+        print(f'{"backend":>12} {"mean [ms]":>10} {"p50 [ms]":>9} {"p90 [ms]":>9} {"scans/s":>8} {"slices/s":>9}')
+        results = {}
+        for name, backend in [('pytorch', model), ('onnxruntime', ort_model)]:
+            logits, latencies = run_scans(backend, scans, settings['warmup_scans'])
+            results[name] = logits
+            print(f'{name:>12} {1e3 * latencies.mean():10.1f} {1e3 * np.median(latencies):9.1f} '
+                  f'{1e3 * np.percentile(latencies, 90):9.1f} {len(scans) / latencies.sum():8.2f} '
+                  f'{num_slices / latencies.sum():9.1f}')
+    max_diff = max((a - b).abs().max().item() for a, b in zip(results['pytorch'], results['onnxruntime']))
+    print(f'max |logit diff|: {max_diff:.2e}')
+
+
+if __name__ == '__main__':
+    with open('configs/' + settings['config_name'] + '.yaml', "r") as yamlfile:
+        config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+    config = utils.RecursiveNamespace(**config)
+    main(config, settings)
@@ -0,0 +1,89 @@
+"""
+Per update cost of utils.PerformanceMetrics vs. the previous implementation, which reduced the confusion counts with
+python's builtin sum() over the boolean tensors. Also checks that both give the same counts.
+"""
+import sys
+import os
+import time
+import torch
+from torch import sigmoid
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.util import PerformanceMetrics
+
+# SETTINGS:
+settings = {
+    'device': 'cuda' if torch.cuda.is_available() else 'cpu',
+    'slice_counts': [20, 30, 40],  # slices of a single scan (one training step)
+    'eval_sizes': [5000, 50000],  # large evaluation sets, updated at once
+    'num_updates': 200,
+    'legacy_max_size': 5000,  # the legacy update is too slow beyond this size
+}
+
+
+class LegacyMetrics(object):
+    def __init__(self, device, bin_thresh=0.5):
+        self.tp = torch.zeros(1, device=device, dtype=torch.int64)
+        self.tn = torch.zeros(1, device=device, dtype=torch.int64)
+        self.fp = torch.zeros(1, device=device, dtype=torch.int64)
+        self.fn = torch.zeros(1, device=device, dtype=torch.int64)
+        self.bin_thresh = bin_thresh
+
+    def update(self, outputs, targets):
+        preds = (sigmoid(outputs) > self.bin_thresh) * 1
+        targets_bools = targets > 0
+        preds_bools = preds > 0
+        self.tp += sum(targets_bools * preds_bools)
+        self.tn += sum(~targets_bools * ~preds_bools)
+        self.fp += sum(~targets_bools * preds_bools)
+        self.fn += sum(targets_bools * ~preds_bools)
+
+
+def sync(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def time_updates(metrics, batches, device):
+    sync(device)
+    start = time.perf_counter()
+    for outputs, targets in batches:
+        metrics.update(outputs, targets)
+    sync(device)
+    return (time.perf_counter() - start) / len(batches)
+
+
+def main():
+    device = settings['device']
+    sizes = settings['slice_counts'] + settings['eval_sizes']
+    print(f'device: {device}')
+    print(f'{"size":>8} {"legacy [us]":>12} {"new [us]":>10}')
+    for size in sizes:
+        num_updates = settings['num_updates'] if size <= max(settings['slice_counts']) else 5
+        batches = [(torch.randn(size, 1, device=device), torch.randint(0, 2, (size, 1), device=device).float())
+                   for _ in range(num_updates)]
+        metrics = PerformanceMetrics(device)
+        new_time = time_updates(metrics, batches, device)
+        if size <= settings['legacy_max_size']:
+            legacy = LegacyMetrics(device)
+            legacy_time = time_updates(legacy, batches, device)
+            for key in ['tp', 'tn', 'fp', 'fn']:
+                assert torch.equal(getattr(legacy, key), getattr(metrics, key)), key
+            legacy_str = f'{1e6 * legacy_time:12.1f}'
+        else:
+            legacy_str = f'{"-":>12}'
+        print(f'{size:8d} {legacy_str} {1e6 * new_time:10.1f}')
+
+    # multi-class outputs get the full confusion matrix
+    metrics = PerformanceMetrics(device)
+    outputs, targets = torch.randn(1000, 4, device=device), torch.randint(0, 4, (1000, 1), device=device)
+    metrics.update(outputs, targets)
+    expected = torch.zeros(4, 4, dtype=torch.int64)
+    for t, p in zip(targets.flatten().tolist(), outputs.argmax(-1).tolist()):
+        expected[t, p] += 1
+    assert torch.equal(metrics.confusion.cpu(), expected)
+    print('multi-class confusion matrix:\n', metrics.confusion.cpu().numpy())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Step time and memory of VisTRcls in fp32 vs. bf16 autocast (utils.autocast, TRAINING.PRECISION / TEST.PRECISION).
+
+For every precision and scan length it reports the mean train step time (forward, backward, clipping, optimizer step),
+the mean inference time, the activation memory saved for backward (measured with saved_tensors_hooks, so it works on
+CPU) and the CUDA peak memory when running on a GPU. The bf16 logits are compared to the fp32 ones.
+"""
+import copy
+import os
+import sys
+import time
+import torch
+import yaml
+from torch import nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils.util as utils
+from models.vistr import build_model
+
+# SETTINGS:
+settings = {
+    'config_name': 'proles_picai_input128_resnet101_pos_emb_sine_t_depth_6_emb_size_2048_mask_crop_prostate',
+    'device': 'cpu',
+    'precisions': ['fp32', 'bf16'],
+    'num_slices': [20, 40],
+    'warmup_steps': 2,
+    'steps': 5,
+    'max_norm': 0.1,
+}
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+class SavedTensorsMeter(object):
+    """Sums the bytes of the (distinct) tensors autograd saves for backward"""
+
+    def __init__(self):
+        self.storages = {}
+
+    def pack(self, tensor):
+        # Tensor.untyped_storage was added in torch 2.0
+        storage = tensor.untyped_storage() if hasattr(tensor, 'untyped_storage') else tensor.storage()
+        self.storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    @property
+    def nbytes(self):
+        return sum(self.storages.values())
+
+
+def train_step(model, criterion, optimizer, samples, targets, device, precision, max_norm):
+    with utils.autocast(device, precision):
+        outputs = model(samples)
+    loss = criterion(outputs.float(), targets)
+    optimizer.zero_grad()
+    loss.backward()
+    if max_norm > 0:
+        torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
+    optimizer.step()
+
+
+def main(config, settings):
+    device = torch.device(settings['device'])
+    config.DEVICE = device
+    torch.manual_seed(0)
+    base_model = build_model(config).to(device)
+    criterion = nn.BCEWithLogitsLoss()
+    size = config.DATA.INPUT_SIZE
+    print(f'{"precision":>9} {"slices":>6} {"train [ms]":>11} {"infer [ms]":>11} {"saved act. [MB]":>16} '
+          f'{"cuda peak [MB]":>15} {"max |dlogit|":>13}')
+    for num_slices in settings['num_slices']:
+        samples = torch.randn(num_slices, 3, size, size, device=device)
+        targets = torch.randint(0, 2, (num_slices, 1), device=device).float()
+        with torch.no_grad():
+            base_model.eval()
+            reference = base_model(samples).float()
+        for precision in settings['precisions']:
+            model = copy.deepcopy(base_model)
+            optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=config.TRAINING.LR)
+
+            # inference
+            model.eval()
+            with torch.no_grad():
+                with utils.autocast(device, precision):
+                    logits = model(samples).float()
+                max_diff = (logits - reference).abs().max().item()
+                sync(device)
+                start = time.perf_counter()
+                for _ in range(settings['steps']):
+                    with utils.autocast(device, precision):
+                        model(samples)
+                sync(device)
+                infer_time = (time.perf_counter() - start) / settings['steps']
+
+            # training
+            model.train()
+            for _ in range(settings['warmup_steps']):
+                train_step(model, criterion, optimizer, samples, targets, device, precision, settings['max_norm'])
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats()
+            meter = SavedTensorsMeter()
+            with torch.autograd.graph.saved_tensors_hooks(meter.pack, lambda tensor: tensor):
+                train_step(model, criterion, optimizer, samples, targets, device, precision, settings['max_norm'])
+            cuda_peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == 'cuda' else float('nan')
+            sync(device)
+            start = time.perf_counter()
+            for _ in range(settings['steps']):
+                train_step(model, criterion, optimizer, samples, targets, device, precision, settings['max_norm'])
+            sync(device)
+            train_time = (time.perf_counter() - start) / settings['steps']
+            print(f'{precision:>9} {num_slices:6d} {1e3 * train_time:11.1f} {1e3 * infer_time:11.1f} '
+                  f'{meter.nbytes / 2 ** 20:16.1f} {cuda_peak:15.1f} {max_diff:13.4f}')
+
+
+if __name__ == '__main__':
+    with open('configs/' + settings['config_name'] + '.yaml', "r") as yamlfile:
+        config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+    config = utils.RecursiveNamespace(**config)
+    main(config, settings)
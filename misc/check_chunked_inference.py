@@ -0,0 +1,76 @@
+"""
+Chunked slice inference (VisTRcls.forward(chunk_size=...), TEST.SLICE_CHUNK_SIZE): checks that the outputs are
+identical to the full pass and reports the peak inference memory for growing scan lengths.
+On CPU the memory is taken from the profiler allocation events, on CUDA from the caching allocator.
+"""
+import os
+import sys
+import torch
+import yaml
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils.util as utils
+from models.vistr import build_model
+
+# SETTINGS:
+settings = {
+    'config_name': 'proles_picai_input128_resnet101_pos_emb_sine_t_depth_6_emb_size_2048_mask_crop_prostate',
+    'device': 'cpu',
+    'num_slices': [20, 40, 80, 160],
+    'chunk_sizes': [None, 8, 16],
+    'atol': 1e-5,
+}
+
+
+def peak_memory(model, scan, chunk_size, device):
+    """Peak memory allocated during the forward pass, in bytes"""
+    with torch.no_grad():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            start = torch.cuda.memory_allocated()
+            torch.cuda.reset_peak_memory_stats()
+            outputs = model(scan, chunk_size=chunk_size)
+            return outputs, torch.cuda.max_memory_allocated() - start
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+            outputs = model(scan, chunk_size=chunk_size)
+    current = peak = 0
+    for event in sorted(prof.events(), key=lambda event: event.time_range.start):
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return outputs, peak
+
+
+def main(config, settings):
+    device = torch.device(settings['device'])
+    config.DEVICE = device
+    torch.manual_seed(0)
+    model = build_model(config).to(device).eval()
+    size = config.DATA.INPUT_SIZE
+    print(f'{"slices":>6} ' + ' '.join(f'{"peak [MB] chunk " + str(chunk_size):>22}'
+                                       for chunk_size in settings['chunk_sizes']) + f' {"max |diff|":>11}')
+    for num_slices in settings['num_slices']:
+        scan = torch.randn(num_slices, 3, size, size, device=device)
+        outputs, peaks = [], []
+        for chunk_size in settings['chunk_sizes']:
+            output, peak = peak_memory(model, scan, chunk_size, device)
+            outputs.append(output)
+            peaks.append(peak)
+        max_diff = max((output - outputs[0]).abs().max().item() for output in outputs)
+        assert max_diff <= settings['atol'], max_diff
+        print(f'{num_slices:6d} ' + ' '.join(f'{peak / 2 ** 20:22.1f}' for peak in peaks) + f' {max_diff:11.2e}')
+
+    # batched scans of different lengths
+    scans = [torch.randn(num_slices, 3, size, size, device=device) for num_slices in (13, 7, 21)]
+    samples, _ = utils.collate_fn([(scan, torch.zeros(scan.shape[0])) for scan in scans])
+    with torch.no_grad():
+        full = model(samples)
+        chunked = model(samples, chunk_size=5)
+    assert (full - chunked).abs().max().item() <= settings['atol']
+    print('OK')
+
+
+if __name__ == '__main__':
+    with open('configs/' + settings['config_name'] + '.yaml', "r") as yamlfile:
+        config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+    config = utils.RecursiveNamespace(**config)
+    main(config, settings)
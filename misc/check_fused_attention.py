@@ -0,0 +1,90 @@
+"""
+Numerical equivalence and speed of the fused (F.scaled_dot_product_attention) and the explicit paths of
+models.transformer.Attention.
+"""
+import os
+import sys
+import time
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.transformer import Attention, HAS_SDPA
+
+# SETTINGS:
+settings = {
+    'device': 'cuda' if torch.cuda.is_available() else 'cpu',
+    'embed_size': 2048,
+    'heads': 8,
+    'shapes': [(40, 17), (20, 257), (40, 257)],  # (slices, tokens per slice incl. the cls token)
+    'dtypes': [torch.float32, torch.bfloat16],
+    'atol': {torch.float32: 1e-5, torch.bfloat16: 2e-2},
+    'steps': 5,
+}
+
+
+def timed(fn, steps, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
+
+
+def saved_bytes(attention, x):
+    """Bytes of the (distinct) tensors saved for backward by a training forward"""
+    storages = {}
+
+    def pack(tensor):
+        # Tensor.untyped_storage was added in torch 2.0
+        storage = tensor.untyped_storage() if hasattr(tensor, 'untyped_storage') else tensor.storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    attention.train()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        attention(x.requires_grad_())
+    attention.eval()
+    x.requires_grad_(False)
+    return sum(storages.values())
+
+
+def main():
+    assert HAS_SDPA, f'F.scaled_dot_product_attention requires torch >= 2.0 (found {torch.__version__})'
+    device = torch.device(settings['device'])
+    torch.manual_seed(0)
+    attention = Attention(settings['embed_size'], num_heads=settings['heads']).to(device).eval()
+    print(f'{"dtype":>14} {"slices":>6} {"tokens":>6} {"max |diff|":>11} {"explicit [ms]":>14} '
+          f'{"fused [ms]":>11} {"explicit saved [MB]":>20} {"fused saved [MB]":>17}')
+    for dtype in settings['dtypes']:
+        attention.to(dtype)
+        for num_slices, num_tokens in settings['shapes']:
+            x = torch.randn(num_slices, num_tokens, settings['embed_size'], device=device, dtype=dtype)
+            with torch.no_grad():
+                attention.fused = False
+                explicit = attention(x)
+                explicit_time = timed(lambda: attention(x), settings['steps'], device)
+                attention.fused = True
+                fused = attention(x)
+                fused_time = timed(lambda: attention(x), settings['steps'], device)
+            attention.fused = False
+            explicit_saved = saved_bytes(attention, x)
+            attention.fused = True
+            fused_saved = saved_bytes(attention, x)
+            max_diff = (explicit.float() - fused.float()).abs().max().item()
+            assert max_diff < settings['atol'][dtype], max_diff
+            print(f'{str(dtype):>14} {num_slices:6d} {num_tokens:6d} '
+                  f'{max_diff:11.2e} {1e3 * explicit_time:14.2f} {1e3 * fused_time:11.2f} '
+                  f'{explicit_saved / 2 ** 20:20.1f} {fused_saved / 2 ** 20:17.1f}')
+
+    # the attention map is still returned by the explicit path
+    out, attn = attention(x, return_attention=True)
+    assert attn.shape == (x.shape[0], settings['heads'], x.shape[1], x.shape[1])
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Accuracy and speed of the dynamic int8 model (TEST.BACKEND: int8) vs. the fp32 checkpoint on a calibration subset of
+PICAI2021Dataset (TEST.DATASET_PATH).
+
+Reports the metrics of both models at TEST.CLS_THRESH and their deltas, the max logit difference, the per scan CPU
+latency and the size of the saved weights.
+"""
+import os
+import random
+import sys
+import time
+import torch
+import yaml
+from torch.utils.data import DataLoader, Subset
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils.util as utils
+from datasets.picai2022 import PICAI2021Dataset
+from models.quantization import quantize_dynamic_int8, serialized_size
+from models.vistr import build_model
+from utils.engine import eval_test
+
+# SETTINGS:
+settings = {
+    'config_name': 'proles_picai_input128_resnet101_pos_emb_sine_t_depth_6_emb_size_2048_mask_crop_prostate',
+    'checkpoint_path': '/mnt/DATA2/Sagi/Models/ProLesClassifier/proles_picai_input128_resnet101_pos_emb_sine_t_depth_6_emb_size_2048_mask_crop_prostate/ckpt/checkpoint0035.pth',
+    'num_calibration_scans': 50,  # None for the full test set
+    'num_threads': 0,  # torch threads, 0 for the default
+    'seed': 0,
+}
+
+METRICS = ['accuracy', 'sensitivity', 'specificity', 'precision', 'f1', 'auroc']
+
+
+def load_calibration_batches(config, settings):
+    dataset = PICAI2021Dataset(config.TEST.DATASET_PATH, scan_set='',
+                               input_size=config.DATA.INPUT_SIZE,
+                               resize_mode=config.DATA.PREPROCESS.RESIZE_MODE,
+                               resize_backend=config.DATA.PREPROCESS.RESIZE_BACKEND,
+                               mask=config.DATA.PREPROCESS.MASK_PROSTATE,
+                               crop_prostate=config.DATA.PREPROCESS.CROP_PROSTATE,
+                               padding=config.DATA.PREPROCESS.CROP_PADDING,
+                               dtype=config.DATA.PREPROCESS.DTYPE)
+    indices = list(range(len(dataset)))
+    if settings['num_calibration_scans'] is not None:
+        indices = sorted(random.Random(settings['seed']).sample(indices, min(settings['num_calibration_scans'],
+                                                                             len(indices))))
+    data_loader = DataLoader(Subset(dataset, indices), batch_size=1, collate_fn=utils.collate_fn,
+                             num_workers=config.TEST.NUM_WORKERS)
+    # loaded once, so both models see the same batches and the timing does not include data loading
+    return list(data_loader)
+
+
+def compare(model, quantized_model, batches, cls_thresh):
+    device = torch.device('cpu')
+    results = {}
+    for name, backend in [('fp32', model), ('int8', quantized_model)]:
+        start = time.perf_counter()
+        metrics = eval_test(backend, batches, device, cls_thresh=cls_thresh)
+        latency = (time.perf_counter() - start) / len(batches)
+        results[name] = {'metrics': metrics, 'latency': latency, 'size': serialized_size(backend)}
+
+    print(f'\n{len(batches)} scans, threshold {cls_thresh}')
+    print(f'{"":>12} {"fp32":>8} {"int8":>8} {"delta":>8}')
+    for metric in METRICS:
+        fp32, int8 = (float(getattr(results[name]['metrics'], metric)) for name in ('fp32', 'int8'))
+        print(f'{metric:>12} {fp32:8.4f} {int8:8.4f} {int8 - fp32:+8.4f}')
+    max_diff = (results['fp32']['metrics'].preds - results['int8']['metrics'].preds).abs().max().item()
+    print(f'max |logit diff|: {max_diff:.4f}')
+    for key, unit, scale in [('latency', 'ms / scan', 1e3), ('size', 'MB', 2 ** -20)]:
+        fp32, int8 = results['fp32'][key] * scale, results['int8'][key] * scale
+        print(f'{key:>12} {fp32:8.1f} {int8:8.1f} [{unit}] x{fp32 / int8:.2f}')
+    return results
+
+
+def main(config, settings):
+    config.DEVICE = torch.device('cpu')
+    if settings['num_threads'] > 0:
+        torch.set_num_threads(settings['num_threads'])
+    model = build_model(config)
+    model.load_state_dict(torch.load(settings['checkpoint_path'], map_location='cpu')['model'])
+    model.eval()
+    quantized_model = quantize_dynamic_int8(model)
+    batches = load_calibration_batches(config, settings)
+    compare(model, quantized_model, batches, config.TEST.CLS_THRESH)
+
+
+if __name__ == '__main__':
+    with open('configs/' + settings['config_name'] + '.yaml', "r") as yamlfile:
+        config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+    config = utils.RecursiveNamespace(**config)
+    main(config, settings)
@@ -2,12 +2,14 @@
 Backbone modules.
 Modified from DETR (https://github.com/facebookresearch/detr)
 """
+import hashlib
 from collections import OrderedDict
 
 import torch
 import torch.nn.functional as F
 import torchvision
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 from torchvision.models._utils import IntermediateLayerGetter
 from typing import Dict, List
 
@@ -52,12 +54,14 @@ class FrozenBatchNorm2d(torch.nn.Module):
         eps = 1e-5
         scale = w * (rv + eps).rsqrt()
         bias = b - rm * scale
-        return x * scale + bias
+        # folded in fp32, cast to the input dtype so bf16 activations are not promoted back to fp32
+        return x * scale.to(x.dtype) + bias.to(x.dtype)
 
 
 class BackboneBase(nn.Module):
 
-    def __init__(self, backbone: nn.Module, train_backbone: bool, num_channels: int, return_interm_layers: bool):
+    def __init__(self, backbone: nn.Module, train_backbone: bool, num_channels: int, return_interm_layers: bool,
+                 checkpoint_layers: List[str] = ()):
         super().__init__()
         for name, parameter in backbone.named_parameters():
             if not train_backbone or 'layer2' not in name and 'layer3' not in name and 'layer4' not in name:
@@ -68,12 +72,57 @@ class BackboneBase(nn.Module):
             return_layers = {'layer4': "0"}
         self.body = IntermediateLayerGetter(backbone, return_layers=return_layers)
         self.num_channels = num_channels
+        # layer groups (e.g. 'layer3') whose activations are recomputed in the backward pass instead of stored
+        self.checkpoint_layers = set(checkpoint_layers)
+        # when set, the input are cached features of this layer (see datasets.feature_cache) and only the layers
+        # after it are run
+        self.input_layer = None
+
+    def frozen_prefix(self):
+        """Names of the leading body layers without trainable parameters"""
+        prefix = []
+        for name, module in self.body.items():
+            if any(parameter.requires_grad for parameter in module.parameters()):
+                break
+            prefix.append(name)
+        return prefix
+
+    def weights_hash(self, layers):
+        """md5 of the weights of the given body layers"""
+        md5 = hashlib.md5()
+        for name in layers:
+            for key, value in self.body[name].state_dict().items():
+                md5.update(f'{name}.{key}'.encode())
+                md5.update(value.detach().cpu().numpy().tobytes())
+        return md5.hexdigest()[:12]
+
+    def forward_until(self, scan, layer):
+        """Output of the body layers up to and including `layer`"""
+        x = scan
+        for name, module in self.body.items():
+            x = module(x)
+            if name == layer:
+                return x
+        raise ValueError(f'Unknown backbone layer {layer}')
 
     def forward(self, scan):
-        xs = self.body(scan)
+        # same as IntermediateLayerGetter.forward, with optional checkpointing of the layer groups
         out: Dict[str, NestedTensor] = {}
-        for name, x in xs.items():
-            out[name] = x
+        x = scan
+        use_checkpoint = self.training and torch.is_grad_enabled()
+        layers = list(self.body.items())
+        if self.input_layer is not None:
+            names = [name for name, _ in layers]
+            layers = layers[names.index(self.input_layer) + 1:]
+            if self.input_layer in self.body.return_layers:
+                out[self.body.return_layers[self.input_layer]] = x
+        for name, module in layers:
+            if use_checkpoint and name in self.checkpoint_layers:
+                x = checkpoint(module, x, use_reentrant=False)
+            else:
+                x = module(x)
+            if name in self.body.return_layers:
+                out[self.body.return_layers[name]] = x
         return out
 
 
@@ -82,12 +131,13 @@ class Backbone(BackboneBase):
     def __init__(self, name: str,
                  train_backbone: bool,
                  return_interm_layers: bool,
-                 dilation: bool):
+                 dilation: bool,
+                 checkpoint_layers: List[str] = ()):
         backbone = getattr(torchvision.models, name)(
             replace_stride_with_dilation=[False, False, dilation],
             pretrained=is_main_process(), norm_layer=FrozenBatchNorm2d)
         num_channels = 512 if name in ('resnet18', 'resnet34') else 2048
-        super().__init__(backbone, train_backbone, num_channels, return_interm_layers)
+        super().__init__(backbone, train_backbone, num_channels, return_interm_layers, checkpoint_layers)
 
 
 class Joiner(nn.Sequential):
@@ -110,7 +160,8 @@ def build_backbone(args):
     position_embedding = build_position_encoding(args)
     train_backbone = args.TRAINING.LR > 0
     return_interm_layers = args.MODEL.BACKBONE.RETURN_INTERM_LAYERS
-    backbone = Backbone(args.MODEL.BACKBONE.NAME, train_backbone, return_interm_layers, args.MODEL.BACKBONE.DILATION)
+    backbone = Backbone(args.MODEL.BACKBONE.NAME, train_backbone, return_interm_layers, args.MODEL.BACKBONE.DILATION,
+                        args.MODEL.BACKBONE.CHECKPOINT_LAYERS)
     model = Joiner(backbone, position_embedding)
     model.num_channels = backbone.num_channels
     return model
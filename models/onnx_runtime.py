@@ -0,0 +1,53 @@
+"""
+ONNX Runtime inference backend for models exported with export.py (format 'onnx').
+"""
+import numpy as np
+import onnxruntime as ort
+import torch
+from torch import nn
+
+from utils.util import NestedTensor
+
+
+class OnnxRuntimeModel(nn.Module):
+    """Runs an exported VisTRcls graph with ONNX Runtime's CPU execution provider.
+
+    It is a drop in replacement of VisTRcls for inference (e.g. in eval_test): the input is a single scan
+    [num_frames x 3 x H x W] or a NestedTensor batch, and the logits of all the unpadded frames are returned in batch
+    order, on the device of the input.
+    """
+
+    def __init__(self, onnx_path, num_threads=0, providers=('CPUExecutionProvider',)):
+        """
+        Parameters:
+            onnx_path: path of the exported .onnx model
+            num_threads: intra-op threads of the session, 0 lets ONNX Runtime use all the physical cores
+            providers: execution providers of the session
+        """
+        super().__init__()
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        # a single scan is processed at a time, parallelism is within the ops
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=list(providers))
+        self.input_name = self.session.get_inputs()[0].name
+
+    def run(self, scan):
+        """Runs a single [num_frames x 3 x H x W] scan, returns the [num_frames x 1] logits as a numpy array"""
+        scan = np.ascontiguousarray(scan.detach().cpu().float().numpy())
+        return self.session.run(None, {self.input_name: scan})[0]
+
+    def forward(self, samples, chunk_size=None):
+        # the exported graph runs whole scans, chunk_size (TEST.SLICE_CHUNK_SIZE) is not supported and ignored
+        if isinstance(samples, NestedTensor):
+            scans, mask = samples.decompose()
+            device = scans.device
+            mask = mask.cpu()
+            logits = [self.run(scan[~scan_mask.to(scan.device)]) for scan, scan_mask in zip(scans, mask)]
+            logits = np.concatenate(logits, axis=0)
+        else:
+            device = samples.device
+            logits = self.run(samples)
+        return torch.from_numpy(logits).to(device)
@@ -6,7 +6,7 @@ import math
 import torch
 from torch import nn
 
-from utils.util import NestedTensor
+from utils.util import NestedTensor, is_tracing
 
 # position encoding for 3 dims
 class PositionEmbeddingSine(nn.Module):
@@ -26,11 +26,23 @@ class PositionEmbeddingSine(nn.Module):
         if scale is None:
             scale = 2 * math.pi
         self.scale = scale
+        # the encoding only depends on the feature map size, it is computed once per (h, w). Not persistent, so
+        # checkpoints are unchanged
+        self.register_buffer('cached_pos', None, persistent=False)
+        self._cached_size = None
 
     def forward(self, scan):
         d, em, h, w = scan.size()
-        mask = torch.ones((self.frames, h, w))
-        mask = mask.reshape(1, self.frames,h,w).to(self.device)
+        if is_tracing():
+            return self.encode(h, w, scan.device)
+        if self.cached_pos is None or self._cached_size != (h, w) or self.cached_pos.device != scan.device:
+            self.cached_pos = self.encode(h, w, scan.device)
+            self._cached_size = (h, w)
+        return self.cached_pos
+
+    def encode(self, h, w, device):
+        """Returns the [1 x frames x 3*num_pos_feats x h x w] encoding"""
+        mask = torch.ones((1, self.frames, h, w), device=device)
         # assert mask is not None
         # not_mask = ~mask
         z_embed = mask.cumsum(1, dtype=torch.float32)
@@ -42,7 +54,7 @@ class PositionEmbeddingSine(nn.Module):
             y_embed = y_embed / (y_embed[:, :, -1:, :] + eps) * self.scale
             x_embed = x_embed / (x_embed[:, :, :, -1:] + eps) * self.scale
 
-        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=scan.device)
+        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=device)
         dim_t = self.temperature ** (2 * (dim_t // 2) / self.num_pos_feats)
 
         pos_x = x_embed[:, :, :, :, None] / dim_t
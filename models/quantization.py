@@ -0,0 +1,29 @@
+"""
+Post-training int8 quantization of VisTRcls for CPU inference.
+"""
+import copy
+import io
+import torch
+from torch import nn
+
+QUANTIZED_MODULES = ('transformer', 'mlp_head')
+
+
+def quantize_dynamic_int8(model, modules=QUANTIZED_MODULES):
+    """Returns a copy of the model in which the nn.Linear layers of the given submodules (the transformer qkv, proj,
+    fc1/fc2 and the classification head by default) are dynamically quantized to int8: the weights are stored in
+    int8 and the activations are quantized per batch at runtime, so no calibration pass is needed.
+    The backbone convolutions stay in fp32. Quantized models run on CPU only.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    for name in modules:
+        setattr(model, name, torch.ao.quantization.quantize_dynamic(getattr(model, name), {nn.Linear},
+                                                                    dtype=torch.qint8))
+    return model
+
+
+def serialized_size(model):
+    """Size in bytes of the saved state_dict"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
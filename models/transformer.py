@@ -5,6 +5,7 @@ from timm.models.layers import DropPath
 
 from torch import nn
 from torch import Tensor
+from torch.utils.checkpoint import checkpoint
 import copy
 from PIL import Image
 from torchvision.transforms import Compose, Resize, ToTensor
@@ -32,31 +33,41 @@ class PatchEmbedding(nn.Module):
         x = self.norm(x)
         return x
 
+# fused attention kernels (flash / memory efficient / cpu), torch >= 2.0
+HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
+
+
 class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0., fused=True):
         super().__init__()
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = head_dim ** -0.5
+        # use F.scaled_dot_product_attention when the attention map is not needed
+        self.fused = fused and HAS_SDPA
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x, mask=None, return_attention=False):
+    def forward(self, x, return_attention=False):
         # x: B, N, C
-        # mask: [B, N, ] torch.bool
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv.unbind(0)   # make torchscript happy (cannot use tensor as tuple)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if self.fused and not return_attention:
+            # the score matrix is never materialized
+            x = F.scaled_dot_product_attention(q, k, v, dropout_p=self.attn_drop.p if self.training else 0.)
+            attn = None
+        else:
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
 
@@ -109,7 +120,8 @@ def _get_clones(module, N):
 
 class TransformerEncoder(nn.Module):
 
-    def __init__(self, embed_size=768, num_heads=8, drop_path=0., forward_expansion=4, forward_drop_p=0., norm_layer=nn.LayerNorm, num_layers=6, norm_output=None):
+    def __init__(self, embed_size=768, num_heads=8, drop_path=0., forward_expansion=4, forward_drop_p=0., norm_layer=nn.LayerNorm, num_layers=6, norm_output=None,
+                 checkpoint_layers=0):
         super().__init__()
         encoder_layer = TransformerEncoderBlock(embed_size=embed_size,
                                                 num_heads=num_heads,
@@ -120,11 +132,17 @@ class TransformerEncoder(nn.Module):
         self.layers = _get_clones(encoder_layer, num_layers)
         self.num_layers = num_layers
         self.norm_output = norm_output
+        # number of blocks (from the first) whose activations are recomputed in the backward pass instead of stored
+        self.checkpoint_layers = checkpoint_layers
 
     def forward(self, src):
         output = src
-        for layer in self.layers:
-            output = layer(output)
+        use_checkpoint = self.training and torch.is_grad_enabled()
+        for i, layer in enumerate(self.layers):
+            if use_checkpoint and i < self.checkpoint_layers:
+                output = checkpoint(layer, output, use_reentrant=False)
+            else:
+                output = layer(output)
         if self.norm_output is not None:
             output = self.norm_output(output)
         return output
@@ -138,7 +156,8 @@ def build_transformer(args):
         forward_drop_p=args.MODEL.TRANSFORMER.FORWARD_DROP_P,
         norm_layer=nn.LayerNorm,
         num_layers=args.MODEL.TRANSFORMER.NUM_LAYERS,
-        norm_output=None
+        norm_output=None,
+        checkpoint_layers=args.MODEL.TRANSFORMER.CHECKPOINT_LAYERS
     )
     # return TransformerEncoder(
     #     d_model=args.hidden_dim,
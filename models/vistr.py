@@ -1,14 +1,18 @@
+from collections import OrderedDict
+
 import torch
 import torch.nn.functional as F
 from torch import nn
 
 from models.backbone import build_backbone
 from models.transformer import build_transformer
+from utils.util import NestedTensor, is_tracing
 
 
 class VisTRcls(nn.Module):
     """ This is the VisTR module that performs video object detection """
-    def  __init__(self, backbone, transformer, num_classes=2, embed_dim=2048, pos_embed_mode='interpolate'):
+    def  __init__(self, backbone, transformer, num_classes=2, embed_dim=2048, pos_embed_mode='interpolate',
+                  pos_cache_size=16):
         """ Initializes the model.
         Parameters:
             backbone: torch module of the backbone to be used. See backbone.py
@@ -18,10 +22,13 @@ class VisTRcls(nn.Module):
                          VisTR can detect in a video. For ytvos, we recommend 10 queries for each frame,
                          thus 360 queries for 36 frames.
             aux_loss: True if auxiliary decoding losses (loss at each decoder layer) are to be used.
+            pos_cache_size: number of resized positional embeddings kept (LRU), 0 disables the cache
         """
         super().__init__()
         self.backbone = backbone
         self.pos_embed_mode = pos_embed_mode
+        self.pos_cache_size = pos_cache_size
+        self._pos_cache = OrderedDict()
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.transformer = transformer
         self.mlp_head = nn.Sequential(
@@ -30,39 +37,60 @@ class VisTRcls(nn.Module):
             # nn.Softmax(dim=1)
         )
 
-    def forward(self, samples):
-        """ The forward expects a NestedTensor, which consists of:
-               - samples.tensors: image sequences, of shape [num_frames x 3 x H x W]
-               - samples.mask: a binary mask of shape [num_frames x H x W], containing 1 on padded pixels
-
-            It returns a dict with the following elements:
-               - "pred_logits": the classification logits (including no-object) for all queries.
-                                Shape= [batch_size x num_queries x (num_classes + 1)]
-               - "pred_boxes": The normalized boxes coordinates for all queries, represented as
-                               (center_x, center_y, height, width). These values are normalized in [0, 1],
-                               relative to the size of each individual image (disregarding possible padding).
-                               See PostProcess for information on how to retrieve the unnormalized bounding box.
-               - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
-                                dictionnaries containing the two above keys for each decoder layer.
+    def forward(self, samples, chunk_size=None):
+        """ The forward expects a NestedTensor, which consists of:
+               - samples.tensors: batched image sequences, of shape [batch_size x num_frames x 3 x H x W]
+               - samples.mask: a binary mask of shape [batch_size x num_frames], containing 1 on padded frames
+            or a single image sequence tensor of shape [num_frames x 3 x H x W].
+
+            Every frame (slice) is classified separately, padded frames are dropped before the backbone.
+            It returns the classification logits of all the unpadded frames, in batch order.
+            Shape= [num_unpadded_frames x (1 if num_classes == 2 else num_classes)]
+
+            chunk_size: if given, the frames are processed in chunks of chunk_size frames (backbone, transformer and
+                        head), which bounds the activation memory regardless of the scan length. The frames only
+                        interact through the positional embedding, which is computed once for the full scans, so
+                        the output is identical to the full pass.
         """
+        if isinstance(samples, NestedTensor):
+            scans, mask = samples.decompose()
+            # the mask is expected on the host (see engine.prepare_batch), so this does not wait for the device
+            lengths = (~mask).sum(1).tolist()
+            keep = (~mask).flatten().nonzero().squeeze(1)
+            samples = scans.flatten(0, 1).index_select(0, keep.to(scans.device, non_blocking=True))
+        else:
+            lengths = [samples.shape[0]]
+        if not chunk_size or chunk_size >= samples.shape[0]:
+            src_proj, pos = self.backbone_features(samples)
+            return self.classify(src_proj + self.scans_pos_embed(pos, lengths, *src_proj.shape[1:]))
+
+        outputs_class = []
+        scans_pos = None
+        for start in range(0, samples.shape[0], chunk_size):
+            src_proj, pos = self.backbone_features(samples[start:start + chunk_size])
+            if scans_pos is None:
+                scans_pos = self.scans_pos_embed(pos, lengths, *src_proj.shape[1:])
+            outputs_class.append(self.classify(src_proj + scans_pos[start:start + src_proj.shape[0]]))
+        return torch.cat(outputs_class, dim=0)
+
+    def backbone_features(self, samples):
+        """Returns the [f x h*w x em] backbone features and the [1 x 1 x frames x h*w x pos_em] positional embedding"""
         features, pos = self.backbone(samples)
         src = features[-1]
-        f, em, h, w = src.size()
         pos = pos[-1]
         pos = pos.flatten(-2).permute(0,1,3,2).unsqueeze(0)
         src_proj = src
         src_proj = src_proj.flatten(-2).permute(0,2,1)
+        return src_proj, pos
 
-        ##### #TODO fix size of pos embeddings
-        if self.pos_embed_mode == 'interpolate':
-            pos = nn.functional.interpolate(pos, size=(f, h * w, em), mode='trilinear',align_corners=False).squeeze()
-        elif self.pos_embed_mode == 'prune':
-            pos = nn.functional.interpolate(pos.squeeze(), size=(em), mode='linear', align_corners=False)
-        else:
-            raise NotImplementedError('Unknown positional embedding mode')
-        #####
-        x = src_proj + pos
-        x = torch.cat([self.cls_token.expand(f, -1, -1), x], dim=1)
+    def scans_pos_embed(self, pos, lengths, hw, em):
+        """Positional embeddings of all the frames [sum(lengths) x h*w x em], sized per scan according to its own
+        number of frames"""
+        return torch.cat([self.resize_pos_embed(pos, length, hw, em) for length in lengths], dim=0)
+
+    def classify(self, x):
+        """Classifies the [f x h*w x em] frame tokens"""
+        x = torch.cat([self.cls_token.expand(x.shape[0], -1, -1), x], dim=1)
         out_transformer = self.transformer(x)
 
         outputs_class = self.mlp_head(out_transformer[:,0,:])
@@ -71,6 +99,29 @@ class VisTRcls(nn.Module):
         # out = {'pred_logits': outputs_class[-1], 'pred_boxes': outputs_coord[-1]}
         return outputs_class #out
 
+    def resize_pos_embed(self, pos, f, hw, em):
+        """Resizes the [1 x 1 x frames x h*w x em] positional embedding to [f x h*w x em]
+        The positional embedding is fixed, so the resized embeddings are kept in a small LRU cache"""
+        use_cache = self.pos_cache_size > 0 and not is_tracing()
+        key = (f, hw, em, pos.dtype, pos.device)
+        if use_cache and key in self._pos_cache:
+            self._pos_cache.move_to_end(key)
+            return self._pos_cache[key]
+        ##### #TODO fix size of pos embeddings
+        if self.pos_embed_mode == 'interpolate':
+            pos = nn.functional.interpolate(pos, size=(f, hw, em), mode='trilinear',align_corners=False)
+        elif self.pos_embed_mode == 'prune':
+            pos = nn.functional.interpolate(pos[0, 0], size=(em), mode='linear', align_corners=False)
+        else:
+            raise NotImplementedError('Unknown positional embedding mode')
+        #####
+        pos = pos.reshape(-1, hw, em)
+        if use_cache:
+            self._pos_cache[key] = pos
+            if len(self._pos_cache) > self.pos_cache_size:
+                self._pos_cache.popitem(last=False)
+        return pos
+
 def build_model(args):
     device = torch.device(args.DEVICE)
     backbone = build_backbone(args)
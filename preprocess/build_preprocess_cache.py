@@ -0,0 +1,40 @@
+"""
+Builds the preprocess cache of PICAI2021Dataset (masked, cropped and resized samples) for the DATA.PREPROCESS
+parameters of a config. The datasets created in main.py and test.py pick it up automatically.
+"""
+import yaml
+
+from datasets.picai2022 import PICAI2021Dataset
+from utils.util import RecursiveNamespace
+
+SETTINGS = {
+    'config_name': 'proles_picai_input128_resnet101_pos_emb_sine_t_depth_6_emb_size_2048_mask_crop_prostate',
+    'scan_sets': ['train', 'val'],  # options: 'train', 'val', 'test' (TEST.DATASET_PATH)
+}
+
+def main(config, settings):
+    for scan_set in settings['scan_sets']:
+        if scan_set == 'test':
+            data_dir, scan_set = config.TEST.DATASET_PATH, ''
+        else:
+            data_dir = config.DATA.DATASET_PATH
+        dataset = PICAI2021Dataset(data_dir, fold_id=config.DATA.DATA_FOLD, scan_set=scan_set,
+                                   input_size=config.DATA.INPUT_SIZE,
+                                   resize_mode=config.DATA.PREPROCESS.RESIZE_MODE,
+                                   resize_backend=config.DATA.PREPROCESS.RESIZE_BACKEND,
+                                   mask=config.DATA.PREPROCESS.MASK_PROSTATE,
+                                   crop_prostate=config.DATA.PREPROCESS.CROP_PROSTATE,
+                                   padding=config.DATA.PREPROCESS.CROP_PADDING,
+                                   dtype=config.DATA.PREPROCESS.DTYPE,  # the cache is stored in the sample dtype
+                                   use_cache=False)
+        print(f'Building preprocess cache for {len(dataset)} scans of {dataset.files_dir}')
+        cache_dir = dataset.build_preprocess_cache()
+        print(f'Saved to {cache_dir}')
+    print('Done!')
+
+if __name__ == '__main__':
+    settings = SETTINGS
+    with open('configs/'+settings['config_name']+'.yaml', "r") as yamlfile:
+        config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+    config = RecursiveNamespace(**config)
+    main(config, settings)
@@ -0,0 +1,107 @@
+"""
+Intensity normalization of scan volumes, shared by preprocess_picai and online inference.
+
+Histogram standardization follows Nyul & Udupa as implemented by torchio's HistogramStandardization (same
+percentiles, landmark ranges and piecewise linear mapping), but works directly on numpy arrays so the landmarks
+are loaded once and no Subject/ScalarImage copies are made.
+"""
+import joblib
+import numpy as np
+
+DEFAULT_CUTOFF = (0.01, 0.99)
+STANDARD_RANGE = (0, 100)
+# landmarks used for the mapping, the quartiles (25, 75) are skipped as in torchio
+RANGE_TO_USE = [0, 1, 2, 4, 5, 6, 7, 8, 10, 11, 12]
+
+
+def get_percentiles(cutoff=DEFAULT_CUTOFF):
+    quartiles = np.arange(25, 100, 25).tolist()
+    deciles = np.arange(10, 100, 10).tolist()
+    return np.array(sorted(set([100 * cutoff[0], 100 * cutoff[1]] + quartiles + deciles)))
+
+
+def rescale_intensity(data):
+    """Min-max rescaling of the volume to [0, 1]"""
+    data = data.astype(np.float32)
+    v_min, v_max = data.min(), data.max()
+    if v_max > v_min:
+        data = (data - v_min) / (v_max - v_min)
+    return data.astype(np.float32)
+
+
+class IntensityNormalizer(object):
+    """Histogram standardization and min-max normalization of a modality.
+
+    Parameters:
+        landmarks: landmarks array or path of landmarks saved with joblib (see create_landmarks), None if
+                   only min-max normalization is used
+        cutoff: percentiles cutoff used to compute the percentiles of the input image
+        epsilon: landmarks closer than epsilon are treated as equal
+    """
+
+    def __init__(self, landmarks=None, cutoff=DEFAULT_CUTOFF, epsilon=1e-5):
+        if isinstance(landmarks, str):
+            landmarks = joblib.load(landmarks)
+        self.landmarks = None if landmarks is None else np.asarray(landmarks)
+        self.percentiles = get_percentiles(cutoff)
+        self.epsilon = epsilon
+
+    def hist_standardize(self, data):
+        if self.landmarks is None:
+            raise ValueError('Histogram standardization requires landmarks')
+        shape = data.shape
+        data = data.reshape(-1).astype(np.float32)
+        percentile_values = np.percentile(data, self.percentiles)
+
+        range_mapping = self.landmarks[RANGE_TO_USE]
+        range_perc = percentile_values[RANGE_TO_USE]
+        diff_perc = np.diff(range_perc)
+        # two equal landmarks (usually background) map to a constant
+        diff_perc[diff_perc < self.epsilon] = np.inf
+        slopes = np.diff(range_mapping) / diff_perc
+        intercepts = range_mapping[:-1] - slopes * range_perc[:-1]
+
+        # piecewise linear mapping, the first and last segments are extrapolated outside the landmarks
+        bin_id = np.digitize(data, range_perc[1:-1], right=False)
+        data_t = slopes[bin_id] * data + intercepts[bin_id]
+        return data_t.reshape(shape).astype(np.float32)
+
+    def __call__(self, data, hist_stnd=False, normalize=True):
+        if hist_stnd:
+            data = self.hist_standardize(data)
+        if normalize:
+            data = rescale_intensity(data)
+        return data
+
+
+class LandmarksAccumulator(object):
+    """Streaming estimation of histogram standardization landmarks (torchio's HistogramStandardization.train).
+
+    The average mapping only needs the percentiles of every image, so each volume is reduced to its percentiles as
+    soon as it is added. Accumulators of different processes can be merged.
+    """
+
+    def __init__(self, cutoff=(0.0, 0.99)):
+        self.percentiles = get_percentiles(cutoff)
+        self.num_images = 0
+        self._weighted_percentiles = np.zeros(len(self.percentiles))
+        self._intercepts = 0.0
+
+    def update(self, data):
+        self.add_percentiles(np.percentile(data.reshape(-1).astype(np.float32), self.percentiles))
+
+    def add_percentiles(self, percentile_values):
+        s1, s2 = STANDARD_RANGE
+        slope = np.nan_to_num((s2 - s1) / (percentile_values[-1] - percentile_values[0]))
+        self._weighted_percentiles += slope * percentile_values
+        self._intercepts += s1 - slope * percentile_values[0]
+        self.num_images += 1
+
+    def merge(self, other):
+        self._weighted_percentiles += other._weighted_percentiles
+        self._intercepts += other._intercepts
+        self.num_images += other.num_images
+
+    @property
+    def landmarks(self):
+        return (self._weighted_percentiles + self._intercepts) / self.num_images
@@ -7,15 +7,18 @@ import json
 import joblib
 import pickle
 import SimpleITK as sitk
-import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import nibabel as nib
 import matplotlib.pyplot as plt
-from torchio.transforms import HistogramStandardization
 
 from preprocess.preprocess_utils import prepare_scan, _bias_corrector, registration, sitk_to_numpy, create_landmarks, \
-    normalize_and_hist_stnd
+    settings_hash, registration_cache_path, apply_transform
+from preprocess.intensity_normalization import IntensityNormalizer
 from preprocess.Attention_Gated_Prostate_MRI.inference_segmentation import seg_inference_single_slice
 from utils.util import RecursiveNamespace
+from datasets.scan_store import build_scan_store, is_scan_store
+from datasets.picai2022 import get_prostate_crop_box, get_prostate_slices
 
 SETTINGS = {
     'workdir': '/mnt/DATA2/Sagi/Data/PICAI/processed_data',
@@ -30,18 +33,171 @@ SETTINGS = {
     'scan_set': 'val',  # options: 'train', 'val'
     'bias_correction_t2w': True,
     'registration': True,
+    'registration_mode': 'per_modality',  # options: 'per_modality' (adc and dwi registered separately) or 'shared_diffusion'
+    'diffusion_reference': 'dwi',  # relavant for shared_diffusion registration_mode: modality the transform is estimated on
+    'registration_cache': True,  # reuse the affine transforms of previous runs (saved in workdir/registration_cache)
     'create_landmarks': False,
     't2w_hist_standardization': True,
     'normalize': True,
+    'num_workers': 8,  # number of cases processed in parallel
+    'scan_store': True,  # also write the memory mapped scan store read by PICAI2021Dataset
 }
 
+def process_case(img, label_file, settings, save_dir, normalizer):
+    """Preprocesses a single case and saves it to save_dir/<scan_id>.pkl"""
+    scan_id = (img[0].split('/')[-1]).split('.')[0][:-5]
+    modalities={
+        't2w': prepare_scan(str(img[0])),
+        'adc': prepare_scan(str(img[1])),
+        'dwi': prepare_scan(str(img[2]))
+    }
+
+    if settings.prostate_seg_type == 'picai':
+        prostate_seg = nib.load(os.path.join(settings.prostate_seg_dir,scan_id + '.nii.gz'))
+        prostate_mask = prostate_seg.get_data().transpose(2, 1, 0)
+
+    labels = nib.load(label_file)
+    seg_labels = labels.get_data()
+    cls_labels = (np.sum(np.squeeze(seg_labels), axis=(0, 1)) > 0).astype(int)
+
+    # if sitk.GetArrayFromImage(modalities['t2w']).astype(np.float32).shape[0]!=len(cls_labels) or \
+    #         sitk.GetArrayFromImage(modalities['t2w']).astype(np.float32).shape[0]!=prostate_mask.shape[0] or \
+    #         sitk.GetArrayFromImage(modalities['t2w']).astype(np.float32).shape[1]!=prostate_mask.shape[1]:
+    #     print(scan_id)
+    #     print(f'data shape{labels.shape}')
+    #     print(f'mask shape{prostate_mask.shape}')
+
+    if settings.bias_correction_t2w:
+        modalities['t2w'] = _bias_corrector(modalities['t2w'])
+
+    # f, ax = plt.subplots(1, 3)
+    # ax[0].imshow(sitk.GetArrayFromImage(modalities['t2w']).astype(np.float32)[10,:,:], cmap='gray')
+    # ax[1].imshow(sitk.GetArrayFromImage(modalities['adc']).astype(np.float32)[10,:,:], cmap='gray')
+    # ax[2].imshow(sitk.GetArrayFromImage(modalities['dwi']).astype(np.float32)[10,:,:], cmap='gray')
+    # plt.show()
+
+    timings = {}
+    if settings.registration:
+        fixed_tag = 't2w_bias_corr' if settings.bias_correction_t2w else ''
+        if settings.registration_mode == 'shared_diffusion':
+            # adc and dwi come from the same acquisition, the transform estimated on one of them is applied to both
+            ref_mod = settings.diffusion_reference
+            other_mod = 'adc' if ref_mod == 'dwi' else 'dwi'
+            ref_idx = list(modalities).index(ref_mod)
+            cache_path = registration_cache_path(settings.registration_cache_dir, img[0], img[ref_idx], fixed_tag)
+            # on a registration cache hit registration() only applies the stored transform
+            registered = not (cache_path is not None and os.path.isfile(cache_path))
+            start_time = time.time()
+            modalities[ref_mod], transform_map = registration(modalities['t2w'], modalities[ref_mod], cache_path)
+            timings['registration_time'] = time.time() - start_time
+            start_time = time.time()
+            modalities[other_mod] = apply_transform(modalities[other_mod], transform_map)
+            timings['apply_transform_time'] = time.time() - start_time
+            if registered:
+                # the second registration that was skipped would have cost about as much as the elastix run
+                timings['registration_time_saved'] = timings['registration_time'] - timings['apply_transform_time']
+        else:
+            adc_cache_path = registration_cache_path(settings.registration_cache_dir, img[0], img[1], fixed_tag)
+            dwi_cache_path = registration_cache_path(settings.registration_cache_dir, img[0], img[2], fixed_tag)
+            start_time = time.time()
+            modalities['adc'], transform_map = registration(modalities['t2w'], modalities['adc'], adc_cache_path)
+            modalities['dwi'], transform_map = registration(modalities['t2w'], modalities['dwi'], dwi_cache_path)
+            timings['registration_time'] = time.time() - start_time
+
+    # f, ax = plt.subplots(1, 3)
+    # ax[0].imshow(sitk.GetArrayFromImage(modalities['t2w']).astype(np.float32)[10,:,:], cmap='gray')
+    # ax[1].imshow(sitk.GetArrayFromImage(modalities['adc']).astype(np.float32)[10,:,:], cmap='gray')
+    # ax[2].imshow(sitk.GetArrayFromImage(modalities['dwi']).astype(np.float32)[10,:,:], cmap='gray')
+    # plt.show()
+
+    sitk_to_numpy(modalities)
+    if settings.normalize:
+        for mod in modalities:
+            hist_stnd = settings.t2w_hist_standardization and mod == 't2w'
+            modalities[mod] = normalizer(modalities[mod], hist_stnd=hist_stnd, normalize=settings.normalize)
+
+    # slice_num = 10
+    # f, ax = plt.subplots(1, 3)
+    # ax[0].imshow(modalities['t2w'][10,:,:], cmap='gray')
+    # ax[1].imshow(modalities['adc'][10,:,:], cmap='gray')
+    # ax[2].imshow(modalities['dwi'][10,:,:], cmap='gray')
+    # plt.show()
+    #
+    # slice_num = 10
+    # f, ax = plt.subplots(1, 3)
+    # ax[0].imshow(modalities['t2w'][slice_num,:,:], cmap='gray')
+    # ax[1].imshow(modalities['t2w'][slice_num,:,:]*prostate_mask[slice_num,:,:], cmap='gray')
+    # ax[2].imshow(modalities['t2w'][slice_num, :, :] * prostate_mask2[slice_num,:, :], cmap='gray')
+    # plt.show()
+    # slice_num = 10
+    # f, ax = plt.subplots(1, 2)
+    # ax[0].imshow(modalities['t2w'][slice_num,:,:], cmap='gray')
+    # ax[1].imshow(modalities['t2w'][slice_num,:,:]*prostate_mask[slice_num,:,:], cmap='gray')
+    # # ax[2].imshow(modalities['t2w'][slice_num, :, :] * prostate_mask2[slice_num,:, :], cmap='gray')
+    # plt.show()
+
+    if settings.prostate_seg_type == 'sheba':
+        prostate_mask = seg_inference_single_slice(modalities['t2w'], settings.sheba_prostate_config_path, resample=True)
+
+    # test = (img[list(modalities).index(modality)].split('/')[-1]).split('.')[0]
+    save_path = os.path.join(save_dir, scan_id + '.pkl')
+    scan_dict = {
+    'modalities': modalities,
+    'prostate_mask': prostate_mask,
+    'seg_labels': seg_labels,
+    'cls_labels': cls_labels,
+    # static for a scan, stored so the dataset does not rescan the mask every epoch.
+    # CROP_PADDING is added to the unpadded box at load time, an empty mask has no box (the full frame is used)
+    'crop_box': get_prostate_crop_box(prostate_mask),
+    'prostate_slices': get_prostate_slices(prostate_mask),
+    }
+
+    # write to a temporary file first, an interrupted run never leaves a truncated pickle behind
+    tmp_path = save_path + '.tmp'
+    with open(tmp_path, 'wb') as handle:
+        pickle.dump(scan_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, save_path)
+
+    # with open(save_path, 'rb') as handle:
+    #     b = pickle.load(handle)
+    return timings
+
+def _init_worker(num_threads):
+    # elastix and N4 are multithreaded themselves, split the cores between the worker processes
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(num_threads)
+
+def _timed_process_case(img, label_file, settings, save_dir, normalizer):
+    start_time = time.time()
+    try:
+        result = process_case(img, label_file, settings, save_dir, normalizer)
+        result['status'] = 'done'
+    except Exception as e:
+        result = {'status': 'failed', 'error': f'{type(e).__name__}: {e}'}
+    result['time'] = time.time() - start_time
+    return result
+
+def load_manifest(manifest_path):
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as fp:
+            return json.load(fp)
+    return {'cases': {}}
+
+def save_manifest(manifest, manifest_path):
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+    os.replace(tmp_path, manifest_path)
+
 def main(settings):
     settings = RecursiveNamespace(**settings)
+    settings.registration_cache_dir = os.path.join(settings.workdir, 'registration_cache') if settings.registration_cache else None
     dir_name = 'processed_data'
     if settings.bias_correction_t2w:
         dir_name += '_t2w_bias_corr'
     if settings.registration:
         dir_name += '_resgist'
+        if settings.registration_mode == 'shared_diffusion':
+            dir_name += '_shared'
     if settings.t2w_hist_standardization:
         dir_name += '_t2w_hist_stnd'
     if settings.normalize:
@@ -55,113 +211,60 @@ def main(settings):
     image_files = np.array(data_json['image_paths'])
     label_files = np.array(data_json['label_paths'])
 
+    landmarks_path = None
     if settings.t2w_hist_standardization:
         landmarks_path = os.path.join(settings.workdir, 'landmarks_t2w.npy')
         if settings.create_landmarks:
-            nifty_dir = os.path.join(settings.workdir, 'nifty_files')
-            os.makedirs(nifty_dir, exist_ok=True)
-            landmarks = create_landmarks(image_files, settings, nifty_dir, modality='t2w', create_nifty=True)
+            landmarks = create_landmarks(image_files, settings, modality='t2w', num_workers=settings.num_workers)
             joblib.dump(landmarks, landmarks_path)
-            shutil.rmtree(nifty_dir)
 
-    count=0
-    for idx, img in enumerate(image_files):
+    # landmarks are loaded once and the normalizer is shared by all the cases
+    normalizer = IntensityNormalizer(landmarks_path)
 
+    cases = []
+    for idx, img in enumerate(image_files):
         scan_id = (img[0].split('/')[-1]).split('.')[0][:-5]
         if not os.path.isfile(os.path.join(settings.prostate_seg_dir,scan_id + '.nii.gz')):
             print(scan_id)
             continue
-        modalities={
-            't2w': prepare_scan(str(img[0])),
-            'adc': prepare_scan(str(img[1])),
-            'dwi': prepare_scan(str(img[2]))
-        }
-
-        if settings.prostate_seg_type == 'picai':
-            prostate_seg = nib.load(os.path.join(settings.prostate_seg_dir,scan_id + '.nii.gz'))
-            prostate_mask = prostate_seg.get_data().transpose(2, 1, 0)
-
-        labels = nib.load(label_files[idx])
-        seg_labels = labels.get_data()
-        cls_labels = (np.sum(np.squeeze(seg_labels), axis=(0, 1)) > 0).astype(int)
-
-        # if sitk.GetArrayFromImage(modalities['t2w']).astype(np.float32).shape[0]!=len(cls_labels) or \
-        #         sitk.GetArrayFromImage(modalities['t2w']).astype(np.float32).shape[0]!=prostate_mask.shape[0] or \
-        #         sitk.GetArrayFromImage(modalities['t2w']).astype(np.float32).shape[1]!=prostate_mask.shape[1]:
-        #     print(scan_id)
-        #     print(f'data shape{labels.shape}')
-        #     print(f'mask shape{prostate_mask.shape}')
-
-        if settings.bias_correction_t2w:
-            modalities['t2w'] = _bias_corrector(modalities['t2w'])
-
-        # f, ax = plt.subplots(1, 3)
-        # ax[0].imshow(sitk.GetArrayFromImage(modalities['t2w']).astype(np.float32)[10,:,:], cmap='gray')
-        # ax[1].imshow(sitk.GetArrayFromImage(modalities['adc']).astype(np.float32)[10,:,:], cmap='gray')
-        # ax[2].imshow(sitk.GetArrayFromImage(modalities['dwi']).astype(np.float32)[10,:,:], cmap='gray')
-        # plt.show()
-
-        if settings.registration:
-            modalities['adc'], transform_map = registration(modalities['t2w'], modalities['adc'])
-            modalities['dwi'], transform_map = registration(modalities['t2w'], modalities['dwi'])
-
-        # f, ax = plt.subplots(1, 3)
-        # ax[0].imshow(sitk.GetArrayFromImage(modalities['t2w']).astype(np.float32)[10,:,:], cmap='gray')
-        # ax[1].imshow(sitk.GetArrayFromImage(modalities['adc']).astype(np.float32)[10,:,:], cmap='gray')
-        # ax[2].imshow(sitk.GetArrayFromImage(modalities['dwi']).astype(np.float32)[10,:,:], cmap='gray')
-        # plt.show()
-
-        sitk_to_numpy(modalities)
-        if settings.normalize:
-            for mod in modalities:
-                if settings.t2w_hist_standardization and mod=='t2w':
-                    landmarks = joblib.load(landmarks_path)
-                    transform = HistogramStandardization({'img': landmarks})
-                    modalities[mod] = normalize_and_hist_stnd(transform, modalities[mod], hist_stnd=True, normalize=settings.normalize)
-                else:
-                    transform = None
-                    modalities[mod] = normalize_and_hist_stnd(transform, modalities[mod], hist_stnd=False, normalize=settings.normalize)
-
-        # slice_num = 10
-        # f, ax = plt.subplots(1, 3)
-        # ax[0].imshow(modalities['t2w'][10,:,:], cmap='gray')
-        # ax[1].imshow(modalities['adc'][10,:,:], cmap='gray')
-        # ax[2].imshow(modalities['dwi'][10,:,:], cmap='gray')
-        # plt.show()
-        #
-        # slice_num = 10
-        # f, ax = plt.subplots(1, 3)
-        # ax[0].imshow(modalities['t2w'][slice_num,:,:], cmap='gray')
-        # ax[1].imshow(modalities['t2w'][slice_num,:,:]*prostate_mask[slice_num,:,:], cmap='gray')
-        # ax[2].imshow(modalities['t2w'][slice_num, :, :] * prostate_mask2[slice_num,:, :], cmap='gray')
-        # plt.show()
-        # slice_num = 10
-        # f, ax = plt.subplots(1, 2)
-        # ax[0].imshow(modalities['t2w'][slice_num,:,:], cmap='gray')
-        # ax[1].imshow(modalities['t2w'][slice_num,:,:]*prostate_mask[slice_num,:,:], cmap='gray')
-        # # ax[2].imshow(modalities['t2w'][slice_num, :, :] * prostate_mask2[slice_num,:, :], cmap='gray')
-        # plt.show()
-
-        if settings.prostate_seg_type == 'sheba':
-            prostate_mask = seg_inference_single_slice(modalities['t2w'], settings.sheba_prostate_config_path, resample=True)
-
-        # test = (img[list(modalities).index(modality)].split('/')[-1]).split('.')[0]
-        save_path = os.path.join(save_dir, scan_id + '.pkl')
-        scan_dict = {
-        'modalities': modalities,
-        'prostate_mask': prostate_mask,
-        'seg_labels': seg_labels,
-        'cls_labels': cls_labels,
-        }
-
-        with open(save_path, 'wb') as handle:
-            pickle.dump(scan_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-        # with open(save_path, 'rb') as handle:
-        #     b = pickle.load(handle)
-        count += 1
-        print(count)
+        cases.append((scan_id, img, label_files[idx]))
+
+    # cases already processed with the same settings are skipped, so an interrupted run continues where it stopped
+    cur_settings_hash = settings_hash(settings, [landmarks_path])
+    manifest_path = os.path.join(save_dir, 'manifest.json')
+    manifest = load_manifest(manifest_path)
+    todo = [case for case in cases
+            if not (manifest['cases'].get(case[0], {}).get('status') == 'done'
+                    and manifest['cases'][case[0]].get('settings_hash') == cur_settings_hash
+                    and os.path.isfile(os.path.join(save_dir, case[0] + '.pkl')))]
+    print(f'{len(cases) - len(todo)} of {len(cases)} cases already processed')
+
+    count = 0
+    num_threads = max(1, (os.cpu_count() or 1) // settings.num_workers)
+    with ProcessPoolExecutor(max_workers=settings.num_workers, initializer=_init_worker,
+                             initargs=(num_threads,)) as executor:
+        futures = {executor.submit(_timed_process_case, img, label_file, settings, save_dir, normalizer): scan_id
+                   for scan_id, img, label_file in todo}
+        for future in as_completed(futures):
+            scan_id = futures[future]
+            manifest['cases'][scan_id] = dict(future.result(), settings_hash=cur_settings_hash)
+            save_manifest(manifest, manifest_path)
+            count += 1
+            case_log = f'{count}/{len(todo)} {scan_id}: {manifest["cases"][scan_id]["status"]} ' \
+                       f'({manifest["cases"][scan_id]["time"]:.1f}s'
+            if 'registration_time_saved' in manifest['cases'][scan_id]:
+                case_log += f', registration time saved: {manifest["cases"][scan_id]["registration_time_saved"]:.1f}s'
+            print(case_log + ')')
+
+    failed = [scan_id for scan_id, case in manifest['cases'].items() if case['status'] != 'done']
+    if failed:
+        print(f'{len(failed)} failed cases (see {manifest_path}): {failed}')
+
+    # the store is only rebuilt when cases were (re)processed, a rebuild replaces the store of running trainings
+    if settings.scan_store and (todo or not is_scan_store(os.path.join(save_dir, 'scan_store'))):
+        print(f'Writing scan store: {build_scan_store(save_dir)}')
     print('Done!')
 
-main(settings=SETTINGS)
+if __name__ == '__main__':
+    main(settings=SETTINGS)
 
@@ -1,13 +1,14 @@
 import numpy as np
 import os
+import hashlib
 from pathlib import Path
 import json
 from tqdm import tqdm
 import SimpleITK as sitk
-import nibabel as nib
-from torchio.transforms import HistogramStandardization
-import skimage
-from torchio import Subject, ScalarImage
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from preprocess.intensity_normalization import LandmarksAccumulator
 
 
 # def prepare_scan(path: str):
@@ -74,7 +75,14 @@ def resample_image(fixedImage=None, movingImage=None, is_label=False):
     params = {'spacing' : out_spacing}
 
     return out
-def registration(fixedImage, movingImage):
+def registration(fixedImage, movingImage, cache_path=None):
+    """Affine registration of movingImage to fixedImage.
+    If cache_path is given, the transform parameter map is saved there and later calls with the same cache_path
+    only apply the stored transform (transformix resampling) instead of optimizing it again."""
+    if cache_path is not None and os.path.isfile(cache_path):
+        transformParameterMap = sitk.VectorOfParameterMap()
+        transformParameterMap.append(sitk.ReadParameterFile(cache_path))
+        return apply_transform(movingImage, transformParameterMap), transformParameterMap
 
     fixedImage = fixedImage
     movingImage = movingImage
@@ -94,79 +102,80 @@ def registration(fixedImage, movingImage):
     resultImage = elastixImageFilter.GetResultImage()
     transformParameterMap = elastixImageFilter.GetTransformParameterMap()
 
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + '.tmp.txt'
+        sitk.WriteParameterFile(transformParameterMap[0], tmp_path)
+        os.replace(tmp_path, cache_path)
+
     return resultImage, transformParameterMap
 
+def apply_transform(movingImage, transformParameterMap):
+    """Resamples movingImage with a transform parameter map estimated by registration()"""
+    transformixImageFilter = sitk.TransformixImageFilter()
+    transformixImageFilter.SetMovingImage(movingImage)
+    transformixImageFilter.SetTransformParameterMap(transformParameterMap)
+    transformixImageFilter.Execute()
+    return transformixImageFilter.GetResultImage()
+
+def registration_cache_path(cache_dir, fixed_path, moving_path, fixed_tag=''):
+    """Path of the cached transform of moving_path to fixed_path, keyed by the content of both input files.
+    fixed_tag describes processing applied to the fixed image before registration (e.g. bias correction)."""
+    if cache_dir is None:
+        return None
+    key = hashlib.md5('_'.join([file_hash(fixed_path), file_hash(moving_path), fixed_tag, 'affine']).encode())
+    return os.path.join(cache_dir, key.hexdigest() + '.txt')
+
 def sitk_to_numpy(modalities):
     for modality, image in modalities.items():
         if isinstance(image, sitk.Image):
             modalities[modality] = sitk.GetArrayFromImage(image).astype(np.float32)
 
-def create_landmarks(image_paths,settings, path_nifty, modality='t2w', create_nifty=False, cutoff=0.99):
-    paths = []
-    cases = {}
-    for img in image_paths:
-        modalities={
-            't2w': prepare_scan(str(img[0])),
-            'adc': prepare_scan(str(img[1])),
-            'dwi': prepare_scan(str(img[2]))
-        }
-
-        # if settings.bias_correction_t2w:
-        #     modalities['t2w'] = _bias_corrector(modalities['t2w'])
-
-        if settings.registration and modality is not 't2w':
-            modalities['adc'], transform_map = registration(modalities['t2w'], modalities['adc'])
-            modalities['dwi'], transform_map = registration(modalities['t2w'], modalities['dwi'])
-
-        sitk_to_numpy(modalities)
-        cases[(img[list(modalities).index(modality)].split('/')[-1]).split('.')[0]] = modalities[modality]
-        # cases[(img[0].split('/')[-1]).split('.')[0][:-5]] = modalities[modality]
-
-    for case_name, case in tqdm(cases.items(), desc='Prepearing nifty files'):
-        nii_filename = os.path.join(path_nifty, case_name + "_" + modality + ".nii.gz")
-        if create_nifty:
-            try:
-                img = cases[case_name]
-            except:
-                input(case_name + " skipped!")
-                continue
-            # img = item_data.modalities_image[modality]
-            # _, v_max = np.percentile(img[img > 0], (0.0, max_percentile))
-            # data_rescaled = skimage.exposure.rescale_intensity(img, in_range=(0.0, v_max), out_range=(0.0, 1.0)).astype(np.float32)
-            data = nib.Nifti1Image(img, affine=np.eye(4))
-            nib.save(data, nii_filename)
-        paths.append(nii_filename)
-
-    # Creates landmarks with cutoff (as precentile) to use
-    landmarks = HistogramStandardization.train(paths, cutoff=(0.0, cutoff))
-    return landmarks
-
-def rescale_data(data, max_percentile=100.00):
-    # v_min, v_max = np.percentile(data, (0.0, max_percentile))
-    # data_rescaled = skimage.exposure.rescale_intensity(data, out_range=(0.0, 1.0))
-    data_rescaled = skimage.exposure.rescale_intensity(data.astype(np.float32), in_range='image',
-                                                       out_range=(0.0, 1.0)).astype(np.float32)
-    # data_rescaled = np.clip(data, 0.0, INTENSITY_NORM_FACTOR) / INTENSITY_NORM_FACTOR
-    return data_rescaled
-
-def normalize_and_hist_stnd(transform, modality_img, hist_stnd = False, normalize=True):
-    if hist_stnd:
-        data = np.expand_dims(modality_img, 0)
-        subject = Subject(img=ScalarImage(tensor=data))
-        subject_t = transform(subject)
-
-        image = subject_t['img']
-        data_t = image.data.numpy()
-        data_t = data_t[0, ...]
-    else:
-        data_t = modality_img
-
-    if normalize:
-        rescaled_data = rescale_data(data_t)
-    else:
-        rescaled_data = data_t
-    # else:  # global normalization
-    #     input("Not implemented!\n")
-    #     # rescaled_data = rescale_data(data_t)
-    #     return None
-    return rescaled_data
+def _case_percentiles(img, settings, modality, percentiles):
+    modalities = {
+        't2w': prepare_scan(str(img[0])),
+        'adc': prepare_scan(str(img[1])),
+        'dwi': prepare_scan(str(img[2]))
+    }
+
+    # if settings.bias_correction_t2w:
+    #     modalities['t2w'] = _bias_corrector(modalities['t2w'])
+
+    if settings.registration and modality != 't2w':
+        cache_path = registration_cache_path(settings.registration_cache_dir, img[0],
+                                             img[list(modalities).index(modality)])
+        modalities[modality], transform_map = registration(modalities['t2w'], modalities[modality], cache_path)
+
+    data = sitk.GetArrayFromImage(modalities[modality]).astype(np.float32)
+    return np.percentile(data.reshape(-1), percentiles)
+
+def create_landmarks(image_paths, settings, modality='t2w', cutoff=0.99, num_workers=1):
+    """Histogram standardization landmarks of a modality over all the given cases.
+    Cases are reduced to their percentiles one at a time (in parallel if num_workers > 1), so at most num_workers
+    volumes are in memory and nothing is written to disk."""
+    accumulator = LandmarksAccumulator(cutoff=(0.0, cutoff))
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(_case_percentiles, image_paths, repeat(settings), repeat(modality),
+                               repeat(accumulator.percentiles))
+        for percentile_values in tqdm(results, total=len(image_paths), desc='Creating landmarks'):
+            accumulator.add_percentiles(percentile_values)
+    return accumulator.landmarks
+
+def file_hash(path, chunk_size=2 ** 20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+# settings that change the content of the processed scans
+OUTPUT_SETTINGS = ['prostate_seg_type', 'prostate_seg_dir', 'sheba_prostate_config_path', 'bias_correction_t2w',
+                   'registration', 'registration_mode', 'diffusion_reference', 't2w_hist_standardization', 'normalize']
+
+def settings_hash(settings, files=()):
+    """Hash of the output related preprocessing settings and of the content of the given files (e.g. landmarks)"""
+    md5 = hashlib.md5(json.dumps({key: getattr(settings, key) for key in OUTPUT_SETTINGS}, sort_keys=True).encode())
+    for path in files:
+        if path is not None and os.path.isfile(path):
+            md5.update(file_hash(path).encode())
+    return md5.hexdigest()
@@ -15,6 +15,7 @@ import seaborn as sns
 # from datasets.picai2022 import prepare_datagens
 
 from models.vistr import build_model
+from models.quantization import quantize_dynamic_int8
 import utils.util as utils
 from utils.engine import eval_test
 from datasets.proles2021_debug import ProLes2021DatasetDebug
@@ -34,24 +35,35 @@ SETTINGS = {
 def main(config, settings):
     utils.init_distributed_mode(config)
     device = torch.device(settings['device'])
+    if config.TEST.BACKEND in ('onnx', 'int8'):
+        # both backends run on the CPU, the batches are not copied to the GPU (and not pinned)
+        device = torch.device('cpu')
     config.DEVICE=device
 
-    model = build_model(config)
-    model.to(device)
-    if isinstance(config.TEST.CHECKPOINT, int):
-        checkpoint_path = os.path.join(config.DATA.OUTPUT_DIR, settings['exp_name'], 'ckpt', f'checkpoint{config.TEST.CHECKPOINT:04}.pth')
-    elif isinstance(config.TEST.CHECKPOINT, str):
-        if '/' in config.TEST.CHECKPOINT:
-            checkpoint_path = config.TEST.CHECKPOINT
-        else:
-            if (config.TEST.CHECKPOINT).endswith('.pth'):
-                checkpoint_path = os.path.join(config.DATA.OUTPUT_DIR, settings['exp_name'], 'ckpt', config.TEST.CHECKPOINT)
-            else:
-                checkpoint_path = ''
+    if config.TEST.BACKEND == 'onnx':
+        # CPU inference of a model exported with export.py
+        from models.onnx_runtime import OnnxRuntimeModel
+        model = OnnxRuntimeModel(config.TEST.ONNX_PATH, num_threads=config.TEST.NUM_THREADS)
     else:
-        checkpoint_path = ''
-    checkpoint = torch.load(checkpoint_path, map_location='cpu')
-    model.load_state_dict(checkpoint['model'])
+        model = build_model(config)
+        model.to(device)
+        if isinstance(config.TEST.CHECKPOINT, int):
+            checkpoint_path = os.path.join(config.DATA.OUTPUT_DIR, settings['exp_name'], 'ckpt', f'checkpoint{config.TEST.CHECKPOINT:04}.pth')
+        elif isinstance(config.TEST.CHECKPOINT, str):
+            if '/' in config.TEST.CHECKPOINT:
+                checkpoint_path = config.TEST.CHECKPOINT
+            else:
+                if (config.TEST.CHECKPOINT).endswith('.pth'):
+                    checkpoint_path = os.path.join(config.DATA.OUTPUT_DIR, settings['exp_name'], 'ckpt', config.TEST.CHECKPOINT)
+                else:
+                    checkpoint_path = ''
+        else:
+            checkpoint_path = ''
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        model.load_state_dict(checkpoint['model'])
+        if config.TEST.BACKEND == 'int8':
+            # dynamic int8 transformer and head, CPU only
+            model = quantize_dynamic_int8(model)
 
     model_without_ddp = model
     if config.distributed:
@@ -77,9 +89,11 @@ def main(config, settings):
     dataset_test = PICAI2021Dataset(config.TEST.DATASET_PATH, scan_set='',
                                    input_size=config.DATA.INPUT_SIZE,
                                    resize_mode=config.DATA.PREPROCESS.RESIZE_MODE,
+                                   resize_backend=config.DATA.PREPROCESS.RESIZE_BACKEND,
                                    mask=config.DATA.PREPROCESS.MASK_PROSTATE,
                                    crop_prostate=config.DATA.PREPROCESS.CROP_PROSTATE,
-                                   padding=config.DATA.PREPROCESS.CROP_PADDING)
+                                   padding=config.DATA.PREPROCESS.CROP_PADDING,
+                                   dtype=config.DATA.PREPROCESS.DTYPE)
 
     if config.distributed:
         sampler_test = DistributedSampler(dataset_test)
@@ -87,9 +101,11 @@ def main(config, settings):
         sampler_test = RandomSampler(dataset_test)
 
     batch_sampler_test = BatchSampler(sampler_test, config.TEST.BATCH_SIZE, drop_last=True)
-    data_loader_test = DataLoader(dataset_test, batch_sampler=batch_sampler_test, num_workers=config.TEST.NUM_WORKERS)
+    data_loader_test = DataLoader(dataset_test, batch_sampler=batch_sampler_test, collate_fn=utils.collate_fn,
+                                  num_workers=config.TEST.NUM_WORKERS, pin_memory=device.type == 'cuda')
 
-    test_stats = eval_test(model, data_loader_test, device, config.TEST.CLIP_MAX_NORM, config.TEST.CLS_THRESH)
+    test_stats = eval_test(model, data_loader_test, device, config.TEST.CLIP_MAX_NORM, config.TEST.CLS_THRESH,
+                           precision=config.TEST.PRECISION, slice_chunk_size=config.TEST.SLICE_CHUNK_SIZE)
     print('#'*100)
     print('Final Test Stats:\n'
           f'Accuracy: {test_stats.accuracy:.3f}\n'
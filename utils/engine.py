@@ -14,10 +14,90 @@ import utils.util as utils
 # from datasets.coco_eval import CocoEvaluator
 # from datasets.panoptic_eval import PanopticEvaluator
 
+def prepare_batch(samples, targets, device, non_blocking=False):
+    """Moves a batch of utils.collate_fn to the device. The targets of the unpadded slices are returned as
+    [num_slices x 1], in the order of the model outputs.
+    The scans are copied before the float conversion, which then runs on the device."""
+    if isinstance(samples, utils.NestedTensor):
+        targets = targets[~samples.mask]
+        # the padding mask stays on the host, the model reads the scan lengths from it without a device sync
+        samples = utils.NestedTensor(samples.tensors.to(device, non_blocking=non_blocking).float(), samples.mask)
+    else:
+        samples, targets = samples.squeeze(0).to(device, non_blocking=non_blocking).float(), targets.squeeze(0)
+    return samples, targets.to(device, non_blocking=non_blocking).float().unsqueeze(1)
+
+class DataPrefetcher(object):
+    """Iterates over the prepared batches (prepare_batch) of a data loader, one batch ahead.
+    On CUDA the next batch is copied (non_blocking, from the pinned buffers of a pin_memory DataLoader) and converted
+    on a side stream while the current step runs, so the training loop does not wait for the host to device copies.
+    On other devices the batches are prepared in the loop, as before."""
+
+    def __init__(self, data_loader, device):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def preload(self, loader_iter):
+        try:
+            samples, targets = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return prepare_batch(samples, targets, self.device, non_blocking=True)
+
+    def __iter__(self):
+        if self.stream is None:
+            for samples, targets in self.data_loader:
+                yield prepare_batch(samples, targets, self.device)
+            return
+        loader_iter = iter(self.data_loader)
+        batch = self.preload(loader_iter)
+        while batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            samples, targets = batch
+            # the batch memory was allocated on the side stream, it must not be reused before the step is done
+            for tensor in (samples.tensors if isinstance(samples, utils.NestedTensor) else samples, targets):
+                tensor.record_stream(current_stream)
+            batch = self.preload(loader_iter)
+            yield samples, targets
+
+def log_metrics(metric_logger, metrics, step, print_freq, sync_free=True):
+    """Updates the metric meters with the running metrics.
+    In sync_free mode the metrics are passed to the meters as device tensors, which are only read (synchronized)
+    when the stats are printed and at the end of the epoch."""
+    if sync_free:
+        metric_logger.update(**metrics.stats())
+    else:
+        metric_logger.update(acc=metrics.accuracy)
+        metric_logger.update(sensitivity=metrics.sensitivity)
+        metric_logger.update(specificity=metrics.specificity)
+        metric_logger.update(precision=metrics.precision)
+        metric_logger.update(f1=metrics.f1)
+    # AUROC sorts the whole history, it is only sampled for the progress prints (the epoch AUROC is computed once by
+    # epoch_stats)
+    if step % print_freq == 0:
+        metric_logger.update(auroc=metrics.auroc)
+
+def epoch_stats(metric_logger, metrics):
+    """Gathers and prints the epoch stats. The meters are averaged over the steps, except for the AUROC meter which
+    only holds the values sampled for the progress prints: the epoch AUROC is computed over all the outputs."""
+    auroc = float(metrics.auroc)
+    metric_logger.update(auroc=auroc)
+    # gather the stats from all processes
+    metric_logger.synchronize_between_processes()
+    print("Averaged stats:", metric_logger)
+    stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    stats['auroc'] = auroc
+    return stats
+
 def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
                     device: torch.device, epoch: int, max_norm: float = 0,
-                    cls_thresh: float = 0.5):
+                    cls_thresh: float = 0.5, sync_free: bool = True, precision: str = 'fp32'):
     model.train()
     criterion.train()
     metrics = utils.PerformanceMetrics(device=device, bin_thresh=cls_thresh)
@@ -32,12 +112,14 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
     metric_logger.add_meter('auroc', utils.SmoothedValue(window_size=1, fmt='{value:.2f}'))
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 50
-    for samples, targets in metric_logger.log_every(data_loader, print_freq, header):
-        samples = samples.squeeze(0).float().to(device)
-        targets = targets.float().T.to(device)
-        outputs = model(samples)
+    for step, (samples, targets) in enumerate(metric_logger.log_every(DataPrefetcher(data_loader, device),
+                                                                      print_freq, header)):
+        with utils.autocast(device, precision):
+            outputs = model(samples)
+        # the loss and the metrics are computed in fp32
+        outputs = outputs.float()
         loss = criterion(outputs, targets)
-        loss_value = loss.item()
+        loss_value = loss.detach() if sync_free else loss.item()
         metrics.update(outputs, targets)
         optimizer.zero_grad()
         loss.backward()
@@ -46,23 +128,16 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
         optimizer.step()
 
         metric_logger.update(loss=loss_value)
-        metric_logger.update(acc=metrics.accuracy)
-        metric_logger.update(sensitivity=metrics.sensitivity)
-        metric_logger.update(specificity=metrics.specificity)
-        metric_logger.update(precision=metrics.precision)
-        metric_logger.update(f1=metrics.f1)
-        metric_logger.update(auroc=metrics.auroc)
+        log_metrics(metric_logger, metrics, step, print_freq, sync_free)
         # metric_logger.update(class_error=loss_dict_reduced['class_error'])
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
 
-    # gather the stats from all processes
-    metric_logger.synchronize_between_processes()
-    print("Averaged stats:", metric_logger)
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    return epoch_stats(metric_logger, metrics)
 
 def eval_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, device: torch.device, epoch: int,
-                    max_norm: float = 0, cls_thresh: float = 0.5):
+                    max_norm: float = 0, cls_thresh: float = 0.5, sync_free: bool = True,
+                    precision: str = 'fp32'):
     with torch.no_grad():
         model.eval()
         criterion.eval()
@@ -77,33 +152,27 @@ def eval_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
         metric_logger.add_meter('auroc', utils.SmoothedValue(window_size=1, fmt='{value:.2f}'))
         header = 'Epoch: [{}]'.format(epoch)
         print_freq = 50
-        for samples, targets in metric_logger.log_every(data_loader, print_freq, header):
-            samples = samples.squeeze(0).float().to(device)
-            targets = targets.float().T.to(device)
-            outputs = model(samples)
+        for step, (samples, targets) in enumerate(metric_logger.log_every(DataPrefetcher(data_loader, device),
+                                                                          print_freq, header)):
+            with utils.autocast(device, precision):
+                outputs = model(samples)
+            outputs = outputs.float()
             loss = criterion(outputs, targets)
-            loss_value = loss.item()
+            loss_value = loss.detach() if sync_free else loss.item()
             metrics.update(outputs, targets)
             # acc = calc_accuracy(outputs, targets)
             # sensitivity, specificity, f1, accuracy = calc_metrics(outputs, targets)
             if max_norm > 0:
                 torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
             metric_logger.update(loss=loss_value)
-            metric_logger.update(acc=metrics.accuracy)
-            metric_logger.update(sensitivity=metrics.sensitivity)
-            metric_logger.update(specificity=metrics.specificity)
-            metric_logger.update(precision=metrics.precision)
-            metric_logger.update(f1=metrics.f1)
-            metric_logger.update(auroc=metrics.auroc)
+            log_metrics(metric_logger, metrics, step, print_freq, sync_free)
             # metric_logger.update(class_error=loss_dict_reduced['class_error'])
 
-    # gather the stats from all processes
-    metric_logger.synchronize_between_processes()
-    print("Averaged stats:", metric_logger)
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    return epoch_stats(metric_logger, metrics)
 
 def eval_test(model: torch.nn.Module, data_loader: Iterable, device: torch.device,
-                    max_norm: float = 0, cls_thresh: float = 0.5):
+                    max_norm: float = 0, cls_thresh: float = 0.5, sync_free: bool = True,
+                    precision: str = 'fp32', slice_chunk_size: int = 0):
     with torch.no_grad():
         model.eval()
         metrics = utils.PerformanceMetrics(device=device, bin_thresh=cls_thresh)
@@ -116,18 +185,15 @@ def eval_test(model: torch.nn.Module, data_loader: Iterable, device: torch.devic
         metric_logger.add_meter('auroc', utils.SmoothedValue(window_size=1, fmt='{value:.2f}'))
         header = 'Test stats: '
         print_freq = 10
-        for samples, targets in metric_logger.log_every(data_loader, print_freq, header):
-            samples = samples.squeeze(0).float().to(device)
-            targets = targets.float().T.to(device)
-            outputs = model(samples)
+        for step, (samples, targets) in enumerate(metric_logger.log_every(DataPrefetcher(data_loader, device),
+                                                                          print_freq, header)):
+            with utils.autocast(device, precision):
+                # chunked slices bound the memory of long scans, with the same outputs
+                outputs = model(samples, chunk_size=slice_chunk_size) if slice_chunk_size else model(samples)
+            outputs = outputs.float()
             metrics.update(outputs, targets)
             if max_norm > 0:
                 torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
-            metric_logger.update(acc=metrics.accuracy)
-            metric_logger.update(sensitivity=metrics.sensitivity)
-            metric_logger.update(specificity=metrics.specificity)
-            metric_logger.update(precision=metrics.precision)
-            metric_logger.update(f1=metrics.f1)
-            metric_logger.update(auroc=metrics.auroc)
+            log_metrics(metric_logger, metrics, step, print_freq, sync_free)
 
     return metrics
@@ -6,7 +6,7 @@ import time
 import datetime
 from collections import defaultdict, deque
 from torch import sigmoid
-from torchmetrics.classification import BinaryAUROC
+from torchmetrics.functional.classification import binary_auroc
 
 
 class RecursiveNamespace(SimpleNamespace):
@@ -66,6 +66,22 @@ def is_main_process():
     return get_rank() == 0
 
 
+def is_tracing():
+    """True while the model is traced or compiled, python side caches are bypassed then"""
+    if torch.jit.is_tracing():
+        return True
+    compiler = getattr(torch, 'compiler', None)  # torch >= 2.1
+    return compiler is not None and compiler.is_compiling()
+
+
+def autocast(device, precision='fp32'):
+    """Autocast context for the configured precision, 'fp32' (disabled) or 'bf16' (CUDA and CPU).
+    The parameters and gradients stay in fp32, so no grad scaler is needed."""
+    if precision not in ('fp32', 'bf16'):
+        raise ValueError(f'Unknown precision {precision}, options: fp32, bf16')
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
 def save_on_master(*args, **kwargs):
     if is_main_process():
         torch.save(*args, **kwargs)
@@ -100,17 +116,22 @@ class NestedTensor(object):
         self.tensors = tensors
         self.mask = mask
 
-    def to(self, device):
-        # type: (Device) -> NestedTensor # noqa
-        cast_tensor = self.tensors.to(device)
+    def to(self, device, non_blocking=False):
+        # type: (Device, bool) -> NestedTensor # noqa
+        cast_tensor = self.tensors.to(device, non_blocking=non_blocking)
         mask = self.mask
         if mask is not None:
             assert mask is not None
-            cast_mask = mask.to(device)
+            cast_mask = mask.to(device, non_blocking=non_blocking)
         else:
             cast_mask = None
         return NestedTensor(cast_tensor, cast_mask)
 
+    def pin_memory(self):
+        # called by the DataLoader pin memory thread (pin_memory=True)
+        mask = self.mask.pin_memory() if self.mask is not None else None
+        return NestedTensor(self.tensors.pin_memory(), mask)
+
     def decompose(self):
         return self.tensors, self.mask
 
@@ -120,6 +141,27 @@ class NestedTensor(object):
 def is_main_process():
     return get_rank() == 0
 
+def collate_fn(batch, slice_bucket=1):
+    """Batches scans with different numbers of slices.
+    Scans are zero padded to the longest scan in the batch, rounded up to a multiple of slice_bucket.
+    Returns a NestedTensor of the scans [B x S x 3 x H x W] with a [B x S] mask (True on padded slices) and the
+    [B x S] slice labels (0 on padded slices)."""
+    scans = [torch.as_tensor(scan) for scan, _ in batch]
+    labels = [torch.as_tensor(label) for _, label in batch]
+    max_len = max(scan.shape[0] for scan in scans)
+    max_len = -(-max_len // slice_bucket) * slice_bucket
+    if len(scans) == 1 and scans[0].shape[0] == max_len:
+        # a single unpadded scan is wrapped without a copy, as a view of the dataset sample buffer
+        return NestedTensor(scans[0].unsqueeze(0), torch.zeros((1, max_len), dtype=torch.bool)), labels[0].unsqueeze(0)
+    tensors = scans[0].new_zeros((len(scans), max_len) + tuple(scans[0].shape[1:]))
+    mask = torch.ones((len(scans), max_len), dtype=torch.bool)
+    targets = labels[0].new_zeros((len(labels), max_len) + tuple(labels[0].shape[1:]))
+    for i, (scan, label) in enumerate(zip(scans, labels)):
+        tensors[i, :scan.shape[0]].copy_(scan)
+        mask[i, :scan.shape[0]] = False
+        targets[i, :label.shape[0]].copy_(label)
+    return NestedTensor(tensors, mask), targets
+
 class SmoothedValue(object):
     """Track a series of values and provide access to smoothed values over a
     window or the global series average.
@@ -134,6 +176,9 @@ class SmoothedValue(object):
         self.fmt = fmt
 
     def update(self, value, n=1):
+        # tensors are kept as is (on their device) and only converted when the stats are read
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
         self.deque.append(value)
         self.count += n
         self.total += value * n
@@ -144,34 +189,37 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        t = torch.tensor([self.count, float(self.total)], dtype=torch.float64, device='cuda')
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
         self.count = int(t[0])
         self.total = t[1]
 
+    def _values(self):
+        return [float(v) for v in self.deque]
+
     @property
     def median(self):
-        d = torch.tensor(list(self.deque))
+        d = torch.tensor(self._values())
         return d.median().item()
 
     @property
     def avg(self):
-        d = torch.tensor(list(self.deque), dtype=torch.float32)
+        d = torch.tensor(self._values(), dtype=torch.float32)
         return d.mean().item()
 
     @property
     def global_avg(self):
-        return self.total / self.count
+        return float(self.total) / self.count
 
     @property
     def max(self):
-        return max(self.deque)
+        return max(self._values())
 
     @property
     def value(self):
-        return self.deque[-1]
+        return float(self.deque[-1])
 
     def __str__(self):
         return self.fmt.format(
@@ -187,9 +235,7 @@ class MetricLogger(object):
 
     def update(self, **kwargs):
         for k, v in kwargs.items():
-            if isinstance(v, torch.Tensor):
-                v = v.item()
-            assert isinstance(v, (float, int))
+            assert isinstance(v, (float, int, torch.Tensor))
             self.meters[k].update(v)
 
     def __getattr__(self, attr):
@@ -270,33 +316,100 @@ class MetricLogger(object):
             header, total_time_str, total_time / len(iterable)))
 
 class PerformanceMetrics(object):
-    """Track a series of values and provide access to smoothed values over a
-    window or the global series average.
+    """Accumulates the confusion matrix and the predictions of all the updates.
+    Predictions are appended to preallocated buffers that grow geometrically, so an update costs O(batch).
+    The AUROC is computed over the full history only when accessed.
+
+    The confusion matrix (rows: targets, columns: predictions) is 2 x 2 for a single logit output and
+    num_classes x num_classes for multi-class outputs. tp/tn/fp/fn are the counts of class 0 (negative) vs. all
+    the other classes (positive).
     """
 
-    def __init__(self, device, bin_thresh=0.5):
+    def __init__(self, device, bin_thresh=0.5, init_capacity=4096):
         self.device = device
-        self.preds = torch.empty((0, 1), device=device, dtype=torch.float32)
-        self.targets = torch.empty((0, 1), device=device, dtype=torch.float32)
-        self.tp = torch.zeros(1, device=device, dtype=torch.int64)
-        self.tn = torch.zeros(1, device=device, dtype=torch.int64)
-        self.fp = torch.zeros(1, device=device, dtype=torch.int64)
-        self.fn = torch.zeros(1, device=device, dtype=torch.int64)
+        self._preds = None
+        self._targets = None
+        self._count = 0
+        self.init_capacity = init_capacity
+        self.confusion = torch.zeros((2, 2), device=device, dtype=torch.int64)
         self.bin_thresh = bin_thresh
 
+    @staticmethod
+    def _grow(buffer, count, capacity):
+        grown = buffer.new_empty((capacity,) + buffer.shape[1:])
+        grown[:count] = buffer[:count]
+        return grown
+
+    def _append(self, outputs, targets):
+        outputs = outputs.detach().float()
+        targets = targets.detach().float()
+        if self._preds is None:
+            self._preds = outputs.new_empty((self.init_capacity,) + outputs.shape[1:])
+            self._targets = targets.new_empty((self.init_capacity,) + targets.shape[1:])
+        end = self._count + outputs.size(0)
+        if end > self._preds.size(0):
+            capacity = max(end, 2 * self._preds.size(0))
+            self._preds = self._grow(self._preds, self._count, capacity)
+            self._targets = self._grow(self._targets, self._count, capacity)
+        self._preds[self._count:end] = outputs
+        self._targets[self._count:end] = targets
+        self._count = end
+
+    @property
+    def preds(self):
+        if self._preds is None:
+            return torch.empty((0, 1), device=self.device, dtype=torch.float32)
+        return self._preds[:self._count]
+
+    @property
+    def targets(self):
+        if self._targets is None:
+            return torch.empty((0, 1), device=self.device, dtype=torch.float32)
+        return self._targets[:self._count]
+
     def update(self, outputs, targets):
-        self.preds = torch.cat((self.preds, outputs), 0)
-        self.targets = torch.cat((self.targets, targets), 0)
+        outputs = outputs.detach()
         if outputs.size(1) == 1:
-            preds = (sigmoid(outputs) > self.bin_thresh) * 1
+            num_classes = 2
+            preds = (sigmoid(outputs.flatten()) > self.bin_thresh).long()
+            targets_idx = (targets.detach().flatten() > 0).long()
         else:
+            num_classes = outputs.size(1)
             preds = outputs.argmax(-1)
-        targets_bools = targets > 0
-        preds_bools = preds > 0
-        self.tp += sum(targets_bools * preds_bools)
-        self.tn += sum(~targets_bools * ~preds_bools)
-        self.fp += sum(~targets_bools * preds_bools)
-        self.fn += sum(targets_bools * ~preds_bools)
+            targets_idx = targets.detach().flatten().long()
+        if self._count == 0 and self.confusion.size(0) != num_classes:
+            self.confusion = self.confusion.new_zeros((num_classes, num_classes))
+        self._append(outputs, targets)
+        # a single scatter-add of the flattened (target, prediction) pairs. Unlike torch.bincount, index_add_ does
+        # not read the number of bins back from the device
+        cells = targets_idx * num_classes + preds
+        self.confusion.view(-1).index_add_(0, cells, torch.ones_like(cells))
+
+    @property
+    def tn(self):
+        return self.confusion[:1, :1].sum().reshape(1)
+
+    @property
+    def fp(self):
+        return self.confusion[:1, 1:].sum().reshape(1)
+
+    @property
+    def fn(self):
+        return self.confusion[1:, :1].sum().reshape(1)
+
+    @property
+    def tp(self):
+        return self.confusion[1:, 1:].sum().reshape(1)
+
+    def stats(self):
+        """Returns the binary metrics as device tensors, without synchronizing with the host"""
+        tp, tn, fp, fn = self.tp, self.tn, self.fp, self.fn
+        return {'acc': (tp + tn) / (tp + tn + fp + fn),
+                'sensitivity': tp / (tp + fn),
+                'specificity': tn / (tn + fp),
+                'precision': tp / (tp + fp),
+                'f1': 2 * tp / (2 * tp + fp + fn)}
+
     @property
     def sensitivity(self):
         return (self.tp / (self.tp + self.fn)).item()
@@ -318,8 +431,8 @@ class PerformanceMetrics(object):
         return ((self.tp + self.tn) / (self.tp + self.tn + self.fp + self.fn)).item()
     @property
     def auroc(self):
-        auroc = BinaryAUROC(thresholds=None)
-        return auroc(self.preds, self.targets)
+        """Exact AUROC over all the predictions so far (sorts the full history, call at log intervals)"""
+        return binary_auroc(self.preds, self.targets.long(), thresholds=None)
 
     # def __str__(self):
     #     return self.fmt.format(